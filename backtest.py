@@ -0,0 +1,285 @@
+"""Backtests a subreddit's conditions against recorded fixture files.
+
+Every top-level condition of the subreddit (plus any proposed ones) is
+checked against every item of its subject in the fixtures, the same way
+check_condition() does while the bot is running, but without performing any
+actions. The redditor lookups for user conditions are served from the
+profiles recorded in the fixtures (see replay.py):
+
+    python backtest.py SUBREDDIT fixtures1.json [fixtures2.json ...]
+        [--conditions proposed.json] [--processes 4] [--latency 0.5]
+
+The proposed conditions file is a JSON list of objects with the same fields
+as the conditions table, e.g.:
+
+    [{"subject": "submission", "attribute": "domain", "action": "remove",
+      "value": "(.*\\\\.)?example\\\\.com",
+      "additional_conditions": [{"subject": "submission",
+                                 "attribute": "user", "value": ".*",
+                                 "account_age": 7}]}]
+
+For each condition, the report shows how many items it was checked against,
+how many it matched, how long it took per item (including any simulated
+request latency), how many requests to reddit it caused, and how many of its
+matches were also matched by another condition. Proposed conditions also get
+a breakdown of which conditions they overlap with.
+
+The database in modbot.cfg is only read from: each worker process checks
+against an in-memory copy of the subreddits and conditions (see
+replay.use_scratch_database()), starting with empty caches, so redditor
+and shadowban lookups are only answered from the fixtures, and meme pages
+aren't fetched. Items recorded in more than one fixture file are only
+checked once, using the first file they're in.
+"""
+import argparse
+import json
+import logging, logging.config
+from multiprocessing import Pool, cpu_count
+from time import time
+
+from sqlalchemy.sql import and_
+
+import modbot
+from models import path_to_cfg, db, Condition, RedditorCache, \
+    ShadowbanCache, MemeCache
+from matching import compile_conditions
+from replay import QUEUES, ReplayReddit, OfflinePool, use_scratch_database
+
+
+def load_proposed(path):
+    """Returns the condition fields from a proposed conditions file."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_condition(fields, ids):
+    """Builds an unsaved Condition (and sub-conditions) from a dict.
+
+    ids is an iterator giving out the ids for the new conditions.
+    """
+    fields = dict(fields)
+    sub_fields = fields.pop('additional_conditions', [])
+    fields.setdefault('inverse', False)
+    condition = Condition(**fields)
+    condition.id = next(ids)
+    condition.additional_conditions = [build_condition(f, ids)
+                                       for f in sub_fields]
+    return condition
+
+
+def new_stats(condition, proposed):
+    return {'action': condition.action,
+            'subject': condition.subject,
+            'attribute': condition.attribute,
+            'value': condition.value,
+            'proposed': proposed,
+            'checked': 0,
+            'errors': 0,
+            'seconds': 0.0,
+            'requests': 0,
+            'matched': set()}
+
+
+def init_worker():
+    logging.config.fileConfig(path_to_cfg)
+    # don't share the parent's database connections
+    db.engine.dispose()
+    use_scratch_database()
+    # slow conditions show up in the results, they aren't disabled
+    modbot.strike_condition.persist = False
+
+
+def backtest_part(task):
+    """Checks the conditions against one part of the fixture files' items.
+
+    Runs in a worker process. The items from all the files are numbered in
+    order, skipping any already seen in an earlier file or queue, and this
+    part checks every parts-th one. Returns a dict of condition id to its
+    stats, with the fullnames of the items it matched.
+    """
+    paths, part, parts, sr_name, proposed, latency = task
+
+    # fresh caches for every part, so nothing carries over from another one
+    modbot.setup_caches()
+    modbot.meme_pool = OfflinePool()
+    for model in (RedditorCache, ShadowbanCache, MemeCache):
+        model.query.delete()
+    db.session.commit()
+
+    # the listings are loaded without latency, only the requests made while
+    # checking conditions count towards their cost
+    replays = [ReplayReddit.from_file(path) for path in paths]
+    modbot.r = replays[0]
+    try:
+        subreddits, sr_dict, snapshot = modbot.load_subreddits()
+        if sr_name.lower() not in sr_dict:
+            raise ValueError('No enabled subreddit named %s' % sr_name)
+        subreddit = sr_dict[sr_name.lower()]
+        conditions = compile_conditions(Condition.query.filter(
+                        and_(Condition.subreddit_id == subreddit.id,
+                             Condition.parent_id == None)).all())
+        is_proposed = dict((c.id, False) for c in conditions)
+
+        # proposed conditions get negative ids, so they can't clash
+        new_ids = iter(xrange(-1, -1000000, -1))
+        for fields in proposed:
+            condition = build_condition(fields, new_ids)
+            conditions.extend(compile_conditions([condition]))
+            is_proposed[condition.id] = True
+
+        stats = dict((c.id, new_stats(c, is_proposed[c.id]))
+                     for c in conditions)
+
+        # items showing up in several queues (or files) are only checked
+        # once, against the conditions of all the queues they're in
+        items = list()
+        applicable = dict()
+        for r in replays:
+            modbot.r = r
+            for name in QUEUES:
+                listing = modbot.get_queue_listing(name, subreddits)
+                if listing is None:
+                    continue
+                queue_condition_ids = set(c.id for c in
+                    modbot.filter_conditions(name, subreddit, conditions))
+                for item in listing:
+                    if item.subreddit.display_name.lower() != sr_name.lower():
+                        continue
+                    if item.name not in applicable:
+                        items.append((r, item))
+                        applicable[item.name] = set()
+                    applicable[item.name] |= queue_condition_ids
+
+        for index, (r, item) in enumerate(items):
+            if index % parts != part:
+                continue
+
+            modbot.r = r
+            subject = modbot.get_subject(item)
+            view = modbot.ItemView(item)
+            r.latency = latency
+            for condition in conditions:
+                if (condition.id not in applicable[item.name] or
+                        condition.subject != subject):
+                    continue
+                entry = stats[condition.id]
+                start_requests = r.requests
+                start_time = time()
+                try:
+                    match = modbot.check_condition(view, condition)
+                except Exception:
+                    match = False
+                    entry['errors'] += 1
+                entry['seconds'] += time() - start_time
+                entry['requests'] += r.requests - start_requests
+                entry['checked'] += 1
+                if match:
+                    entry['matched'].add(item.name)
+            r.latency = 0.0
+        return stats
+    finally:
+        db.session.rollback()
+        db.session.remove()
+
+
+def merge_stats(results):
+    """Adds up the stats from all the parts."""
+    totals = dict()
+    for stats in results:
+        for condition_id, entry in stats.items():
+            if condition_id not in totals:
+                totals[condition_id] = entry
+                continue
+            total = totals[condition_id]
+            for key in ('checked', 'errors', 'seconds', 'requests'):
+                total[key] += entry[key]
+            total['matched'] |= entry['matched']
+    return totals
+
+
+def report(totals):
+    """Prints the per-condition results and proposed conditions' overlaps."""
+    print '%-8s %-7s %-10s %-18s %8s %8s %7s %9s %9s %7s' % ('id',
+        'action', 'subject', 'attribute', 'checked', 'matches', 'rate',
+        'ms/item', 'requests', 'shared')
+
+    order = sorted(totals, key=lambda i: (totals[i]['proposed'], abs(i)))
+    for condition_id in order:
+        entry = totals[condition_id]
+        others = set()
+        for other_id in order:
+            if other_id != condition_id:
+                others |= totals[other_id]['matched']
+        matches = len(entry['matched'])
+        checked = entry['checked']
+
+        print '%-8s %-7s %-10s %-18s %8d %8d %6.1f%% %9.3f %9d %7d' % (
+            ('new%d' % -condition_id) if entry['proposed'] else condition_id,
+            entry['action'], entry['subject'], entry['attribute'],
+            checked, matches,
+            100.0 * matches / checked if checked else 0.0,
+            1000.0 * entry['seconds'] / checked if checked else 0.0,
+            entry['requests'],
+            len(entry['matched'] & others))
+        if entry['errors']:
+            print '         (%d errors while checking)' % entry['errors']
+
+    for condition_id in order:
+        entry = totals[condition_id]
+        if not entry['proposed'] or not entry['matched']:
+            continue
+        overlaps = list()
+        for other_id in order:
+            other = totals[other_id]
+            if other_id == condition_id or other['proposed']:
+                continue
+            shared = len(entry['matched'] & other['matched'])
+            if shared:
+                overlaps.append((shared, other_id))
+        overlaps.sort(reverse=True)
+        print
+        print 'new%d (%s): %s' % (-condition_id, entry['value'],
+            ', '.join('#%s (%d)' % (other_id, shared)
+                      for shared, other_id in overlaps) or
+            'no overlap with existing conditions')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Backtests conditions against recorded fixture files.')
+    parser.add_argument('subreddit')
+    parser.add_argument('fixtures', nargs='+')
+    parser.add_argument('--conditions',
+        help='JSON file of proposed conditions to test alongside the '
+             'subreddit\'s current ones')
+    parser.add_argument('--processes', type=int, default=cpu_count(),
+        help='how many worker processes to spread the items over')
+    parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds of simulated latency per request made by conditions')
+    args = parser.parse_args()
+
+    logging.config.fileConfig(path_to_cfg)
+    proposed = list()
+    if args.conditions:
+        proposed = load_proposed(args.conditions)
+
+    parts = max(args.processes, 1)
+    tasks = [(args.fixtures, part, parts, args.subreddit, proposed,
+              args.latency)
+             for part in range(parts)]
+
+    start_time = time()
+    pool = Pool(parts, initializer=init_worker)
+    try:
+        results = pool.map(backtest_part, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    report(merge_stats(results))
+    logging.info('Backtested %s fixture files in %s', len(args.fixtures),
+                 modbot.elapsed_since(start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class TTLCache(object):
+
+    """In-process cache with a per-entry time-to-live and LRU eviction.
+
+    ttl - Seconds an entry stays valid after being set
+    max_size - Once the cache holds this many entries, the least-recently
+        used one is evicted to make room for a new one
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if missing/expired."""
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires < time():
+                self.misses += 1
+                return default
+
+            # re-insert to mark it as the most recently used
+            self.entries[key] = (expires, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches value for key, optionally with a different ttl."""
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time() + ttl, value)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,125 @@
+import logging
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ConditionStats
+
+Stats = namedtuple('Stats',
+    ['evaluations', 'matches', 'total_seconds', 'requests'])
+
+
+class ConditionStatsTracker(object):
+
+    """Keeps running totals of how each condition does when it's checked.
+
+    Checks are recorded in-process with record(), and added to the
+    condition_stats table with flush(). load() reads the saved totals, and
+    get() returns them with anything recorded since added on.
+
+    window - Once a condition has more evaluations than this, all its totals
+        are scaled down to it, so older checks count for less
+    """
+
+    def __init__(self, window=10000):
+        self.window = window
+        self.saved = dict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Loads the saved totals for every condition."""
+        saved = dict()
+        for stats in ConditionStats.query:
+            saved[stats.condition_id] = Stats(stats.evaluations,
+                                              stats.matches,
+                                              stats.total_seconds,
+                                              stats.requests)
+        with self.lock:
+            self.saved = saved
+
+    def record(self, condition_id, seconds, requests, matched):
+        """Records one check of a condition."""
+        with self.lock:
+            stats = self.pending.get(condition_id, Stats(0, 0, 0.0, 0))
+            self.pending[condition_id] = Stats(stats.evaluations + 1,
+                                               stats.matches + int(matched),
+                                               stats.total_seconds + seconds,
+                                               stats.requests + requests)
+
+    def get(self, condition_id):
+        """Returns a condition's Stats, or None if it hasn't been checked."""
+        with self.lock:
+            saved = self.saved.get(condition_id)
+            pending = self.pending.get(condition_id)
+        if saved is None:
+            return pending
+        if pending is None:
+            return saved
+        return Stats(*[a + b for a, b in zip(saved, pending)])
+
+    def flush(self):
+        """Adds everything recorded since the last flush to the table."""
+        with self.lock:
+            pending, self.pending = self.pending, dict()
+        # alerts and proposed (backtested) conditions have no real id
+        pending = dict((i, s) for i, s in pending.items()
+                       if i is not None and i > 0)
+        if not pending:
+            return
+
+        rows = dict((s.condition_id, s) for s in ConditionStats.query.filter(
+                        ConditionStats.condition_id.in_(pending.keys())))
+        now = datetime.utcnow()
+        saved = dict()
+        new = dict()
+        for condition_id, added in pending.items():
+            row = rows.get(condition_id)
+            if row is None:
+                new[condition_id] = added
+            else:
+                saved[condition_id] = self._apply(row, added, now)
+        db.session.commit()
+
+        # each new row in its own transaction, so if another worker inserted
+        # one first only that insert fails, and the checks are added to their
+        # row instead
+        for condition_id, added in new.items():
+            row = ConditionStats()
+            row.condition_id = condition_id
+            totals = self._apply(row, added, now)
+            db.session.add(row)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                logging.debug('  Stats for condition %s were saved by '
+                              'another worker, adding to them', condition_id)
+                row = ConditionStats.query.filter(
+                        ConditionStats.condition_id == condition_id).one()
+                totals = self._apply(row, added, now)
+                db.session.commit()
+            saved[condition_id] = totals
+
+        with self.lock:
+            self.saved.update(saved)
+
+    def _apply(self, row, added, now):
+        """Adds stats to a row's totals, returning the new totals."""
+        if row.evaluations is None:
+            totals = added
+        else:
+            totals = Stats(row.evaluations + added.evaluations,
+                           row.matches + added.matches,
+                           row.total_seconds + added.total_seconds,
+                           row.requests + added.requests)
+        if totals.evaluations > self.window:
+            scale = float(self.window) / totals.evaluations
+            totals = Stats(*[t * scale for t in totals])
+
+        row.evaluations, row.matches, row.total_seconds, row.requests = \
+            totals
+        row.updated_time = now
+        return totals
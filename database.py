@@ -0,0 +1,73 @@
+import threading
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.ext.declarative import declarative_base
+
+
+class _QueryProperty(object):
+
+    """Gives model classes a query attribute, like Flask-SQLAlchemy does."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __get__(self, obj, cls):
+        return self.db.session.query(cls)
+
+
+class Database(object):
+
+    """Plain SQLAlchemy stand-in for Flask-SQLAlchemy's db object.
+
+    Provides the same names the models and the bot use (db.Model with
+    Model.query, db.session, db.engine, db.metadata, db.create_all() and
+    everything from sqlalchemy and sqlalchemy.orm, like db.Column), without
+    needing a Flask app. The engine is only created the first time it's
+    used, from the URI returned by get_uri.
+
+    db.session is a scoped (thread-local) session: anything handling
+    requests or running in threads should call db.session.remove() when
+    it's done.
+    """
+
+    def __init__(self, get_uri):
+        for module in (sqlalchemy, sqlalchemy.orm):
+            for name in module.__all__:
+                if not hasattr(Database, name):
+                    setattr(self, name, getattr(module, name))
+
+        self.get_uri = get_uri
+        self._engine = None
+        self.lock = threading.Lock()
+        self.session = sqlalchemy.orm.scoped_session(self._create_session)
+        self.Model = declarative_base()
+        self.Model.query = _QueryProperty(self)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            with self.lock:
+                if self._engine is None:
+                    # Flask-SQLAlchemy's default, kept so strings come back
+                    # the same way as before
+                    self._engine = sqlalchemy.create_engine(
+                        self.get_uri(), convert_unicode=True)
+        return self._engine
+
+    def use_engine(self, engine):
+        """Switches to another engine, e.g. a scratch database."""
+        with self.lock:
+            self._engine = engine
+        self.session.remove()
+
+    @property
+    def metadata(self):
+        return self.Model.metadata
+
+    def _create_session(self):
+        return sqlalchemy.orm.Session(bind=self.engine)
+
+    def create_all(self):
+        """Creates all the tables that don't exist yet."""
+        self.metadata.create_all(bind=self.engine)
@@ -0,0 +1,104 @@
+import httplib
+import socket
+import threading
+import urlparse
+
+
+class HTTPPoolError(IOError):
+    """Raised when a page can't be fetched successfully."""
+
+
+class ConnectionPool(object):
+
+    """Fetches pages over keep-alive HTTP connections, reused per host.
+
+    timeout - Seconds before a connect or read is abandoned, so one slow host
+        can't stall the caller
+    max_idle - How many idle connections to keep open for each host
+    max_redirects - How many redirects to follow before giving up
+    """
+
+    def __init__(self, user_agent, timeout=10, max_idle=2, max_redirects=5):
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def fetch(self, url):
+        """Returns the body of the page at url, following redirects."""
+        for _ in range(self.max_redirects + 1):
+            response, body = self._request(url)
+            if response.status in (301, 302, 303, 307):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status != 200:
+                raise HTTPPoolError('%s returned status %s'
+                                    % (url, response.status))
+            return body
+        raise HTTPPoolError('too many redirects for %s' % url)
+
+    def _request(self, url):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?'+parts.query
+        headers = {'User-Agent': self.user_agent,
+                   'Connection': 'keep-alive'}
+
+        conn, reused = self._acquire(key)
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+            # the server may have dropped an idle connection, try a new one
+            conn = self._connect(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(key, conn)
+        return response, body
+
+    def _acquire(self, key):
+        """Returns (connection, whether it's a reused idle one)."""
+        with self.lock:
+            idle = self.idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._connect(key), False
+
+    def _connect(self, key):
+        scheme, netloc = key
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, list())
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self.lock:
+            for idle in self.idle.values():
+                for conn in idle:
+                    conn.close()
+            self.idle.clear()
@@ -0,0 +1,175 @@
+import logging
+import socket
+from datetime import datetime, timedelta
+
+from sqlalchemy.sql import and_
+from sqlalchemy.exc import IntegrityError
+
+from models import cfg_file, db, SubredditLease, WorkerHeartbeat
+
+
+def default_worker_id():
+    """Returns an id for this worker, from the host and reddit account.
+
+    It stays the same between runs, so a worker started from cron keeps its
+    leases from one run to the next.
+    """
+    return '%s:%s' % (socket.gethostname(),
+                      cfg_file.get('reddit', 'username'))
+
+
+class LeaseManager(object):
+
+    """Claims a share of the subreddits for this worker through lease rows.
+
+    Each worker renews its worker_heartbeats row and its leases with claim()
+    (the heartbeat). Subreddits without a lease, or whose lease hasn't been
+    renewed in lease_ttl seconds because its worker died, are up for grabs.
+    Each worker aims for an equal share of the subreddits between the live
+    workers (the ones with a recent heartbeat row, whether or not they hold
+    any leases yet), and gives up any leases past that share so a newly
+    started worker gets some on its next claim.
+
+    worker - This worker's id, see default_worker_id()
+    lease_ttl - Seconds without a heartbeat before a lease can be taken over
+    """
+
+    def __init__(self, worker, lease_ttl=600):
+        self.worker = worker
+        self.lease_ttl = lease_ttl
+
+    def claim(self, subreddit_ids):
+        """Renews and rebalances this worker's leases.
+
+        subreddit_ids is every subreddit that needs a worker. Returns the set
+        of ids this worker now holds leases for.
+        """
+        now = datetime.utcnow()
+        expiry = now - timedelta(seconds=self.lease_ttl)
+        subreddit_ids = set(subreddit_ids)
+
+        # heartbeat first, so this worker counts towards the share and none
+        # of its leases look stale
+        self._heartbeat(now)
+        (db.session.query(SubredditLease)
+            .filter(SubredditLease.worker == self.worker)
+            .update({'heartbeat_time': now}, synchronize_session=False))
+        db.session.commit()
+
+        # plain tuples, since the commits below expire any loaded objects
+        leases = (db.session.query(SubredditLease.id,
+                                   SubredditLease.subreddit_id,
+                                   SubredditLease.worker,
+                                   SubredditLease.heartbeat_time)
+                    .all())
+        owned = set(l.subreddit_id for l in leases
+                    if l.worker == self.worker)
+        heartbeats = (db.session.query(WorkerHeartbeat.worker)
+                        .filter(WorkerHeartbeat.heartbeat_time >= expiry)
+                        .all())
+        live_workers = set(h.worker for h in heartbeats)
+        live_workers.add(self.worker)
+        stale = dict((l.subreddit_id, l) for l in leases
+                     if l.heartbeat_time < expiry)
+        free = subreddit_ids - set(l.subreddit_id for l in leases)
+
+        # drop leases for subreddits that have been disabled
+        gone = owned - subreddit_ids
+        self.release(gone)
+        owned.difference_update(gone)
+
+        # everyone's fair share, rounded up so no subreddit is left over
+        share = -(-len(subreddit_ids) // len(live_workers))
+
+        if len(owned) > share:
+            extra = sorted(owned)[share:]
+            self.release(extra)
+            owned.difference_update(extra)
+            logging.info('Released %s subreddits for other workers',
+                         len(extra))
+
+        for subreddit_id in sorted(free):
+            if len(owned) >= share:
+                break
+            if self._insert(subreddit_id, now):
+                owned.add(subreddit_id)
+
+        for subreddit_id in sorted(stale):
+            if len(owned) >= share:
+                break
+            if subreddit_id not in subreddit_ids:
+                continue
+            if self._take_over(stale[subreddit_id], now, expiry):
+                owned.add(subreddit_id)
+
+        return owned
+
+    def _heartbeat(self, now):
+        count = (db.session.query(WorkerHeartbeat)
+                    .filter(WorkerHeartbeat.worker == self.worker)
+                    .update({'heartbeat_time': now},
+                            synchronize_session=False))
+        db.session.commit()
+        if count:
+            return
+        heartbeat = WorkerHeartbeat()
+        heartbeat.worker = self.worker
+        heartbeat.heartbeat_time = now
+        db.session.add(heartbeat)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # the same worker id started twice, its row is fresh either way
+            db.session.rollback()
+
+    def _insert(self, subreddit_id, now):
+        lease = SubredditLease()
+        lease.subreddit_id = subreddit_id
+        lease.worker = self.worker
+        lease.acquired_time = now
+        lease.heartbeat_time = now
+        db.session.add(lease)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another worker got there first
+            db.session.rollback()
+            return False
+        return True
+
+    def _take_over(self, lease, now, expiry):
+        # only succeeds if the lease is still stale when the update runs, so
+        # two workers can't both take the same one over
+        count = (db.session.query(SubredditLease)
+                    .filter(and_(SubredditLease.id == lease.id,
+                                 SubredditLease.worker == lease.worker,
+                                 SubredditLease.heartbeat_time < expiry))
+                    .update({'worker': self.worker,
+                             'acquired_time': now,
+                             'heartbeat_time': now},
+                            synchronize_session=False))
+        db.session.commit()
+        if count:
+            logging.info('Took over subreddit %s from %s',
+                         lease.subreddit_id, lease.worker)
+        return bool(count)
+
+    def release(self, subreddit_ids=None):
+        """Gives up leases, or all of this worker's leases if ids is None.
+
+        Giving them all up also removes the worker's heartbeat row, so the
+        other workers stop leaving a share for it.
+        """
+        query = (db.session.query(SubredditLease)
+                    .filter(SubredditLease.worker == self.worker))
+        if subreddit_ids is not None:
+            if not subreddit_ids:
+                return
+            query = query.filter(
+                SubredditLease.subreddit_id.in_(list(subreddit_ids)))
+        else:
+            (db.session.query(WorkerHeartbeat)
+                .filter(WorkerHeartbeat.worker == self.worker)
+                .delete(synchronize_session=False))
+        query.delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,706 @@
+import re
+import logging
+import threading
+import multiprocessing
+import sre_parse
+from time import time
+from sre_constants import LITERAL, IN, BRANCH, SUBPATTERN, ANY, \
+    MAX_REPEAT, MIN_REPEAT, MAXREPEAT
+
+# linear-time regex engine, used for risky patterns if it's installed
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+# flags every condition regex is compiled with
+REGEX_FLAGS = re.DOTALL|re.UNICODE
+
+# literal-set detection gives up on patterns expanding to more strings
+MAX_LITERALS = 100000
+
+# seconds a single regex search may take, see set_time_budget()
+time_budget = 1.0
+
+
+class MatchTimeout(Exception):
+    """Raised when a guarded regex search goes over the time budget."""
+
+
+def set_time_budget(seconds):
+    """Sets how long a single regex search may take.
+
+    Risky patterns checked in the watchdog process are stopped after this
+    long, and anything else going over it can be counted against its
+    condition by the caller.
+    """
+    global time_budget
+    time_budget = seconds
+
+
+def get_matcher(condition):
+    """Returns the compiled matcher for a condition's value.
+
+    Matchers are cached by value, so each distinct pattern is only compiled
+    once, and a condition whose value changes gets recompiled automatically.
+    Values that only match a finite set of literal strings (optionally with
+    any prefix, or any subdomain) get a LiteralMatcher doing hash/trie
+    lookups instead of a regex, and values that could backtrack
+    catastrophically (see is_risky()) get a GuardedMatcher. Raises re.error
+    if the value isn't a valid regex.
+    """
+    try:
+        return get_matcher.cache[condition.value]
+    except KeyError:
+        pass
+
+    pattern = '^'+condition.value.lower()+'$'
+    matcher = re.compile(pattern, REGEX_FLAGS)
+    literals = parse_literals(condition.value)
+    if literals:
+        index_class, strings = literals
+        matcher = LiteralMatcher(index_class(), strings)
+    elif is_risky(condition.value):
+        matcher = GuardedMatcher(pattern, matcher)
+    get_matcher.cache[condition.value] = matcher
+    return matcher
+get_matcher.cache = dict()
+
+
+def retain_matchers(conditions):
+    """Drops the cached matchers that none of the conditions use anymore.
+
+    Sub-conditions count too. Without this, the cache would keep a matcher
+    for every value a condition has ever had.
+    """
+    values = set()
+    pending = list(conditions)
+    while pending:
+        condition = pending.pop()
+        values.add(condition.value)
+        pending.extend(condition.additional_conditions)
+    for value in get_matcher.cache.keys():
+        if value not in values:
+            del get_matcher.cache[value]
+
+
+def compile_condition(condition):
+    """Compiles a condition and all of its sub-conditions.
+
+    Returns True if everything compiled, or False if any of the values is
+    not a valid regex. Invalid values are logged the first time they're seen.
+    """
+    try:
+        get_matcher(condition)
+    except re.error as e:
+        if condition.value not in compile_condition.invalid:
+            compile_condition.invalid.add(condition.value)
+            logging.error('  ERROR: condition #%s has invalid regex "%s": %s',
+                          condition.id,
+                          condition.value.encode('ascii', 'ignore'),
+                          e)
+        return False
+
+    if (isinstance(get_matcher(condition), GuardedMatcher) and
+            condition.value not in compile_condition.risky):
+        compile_condition.risky.add(condition.value)
+        logging.warning('  Condition #%s has a regex that could take very '
+                        'long to check, "%s", using %s for it',
+                        condition.id,
+                        condition.value.encode('ascii', 'ignore'),
+                        're2' if get_matcher(condition).re2 else
+                        'a watchdog process')
+
+    for sub_condition in condition.additional_conditions:
+        if not compile_condition(sub_condition):
+            return False
+    return True
+compile_condition.invalid = set()
+compile_condition.risky = set()
+
+
+def compile_conditions(conditions):
+    """Returns only the conditions that compiled successfully."""
+    return [c for c in conditions if compile_condition(c)]
+
+
+def is_risky(value):
+    """Returns True if a regex could backtrack catastrophically.
+
+    That's the case for nested repeats where both can repeat any number of
+    times, e.g. "(a+)+" or "(.*,)*x": a string that almost matches makes the
+    regex engine try every way of splitting it up between the two.
+    """
+    try:
+        parsed = sre_parse.parse(value.lower(), REGEX_FLAGS)
+    except Exception:
+        return False
+    return has_nested_repeat(list(parsed), False)
+
+
+def has_nested_repeat(items, in_repeat):
+    """Returns True if a parsed regex sequence has an unbounded repeat inside
+    another one (in_repeat says if the sequence is inside one already)."""
+    for op, av in items:
+        if op in (MAX_REPEAT, MIN_REPEAT):
+            unbounded = av[1] == MAXREPEAT or av[1] > 100
+            if unbounded and in_repeat:
+                return True
+            if has_nested_repeat(list(av[2]), in_repeat or unbounded):
+                return True
+        elif op == SUBPATTERN:
+            if has_nested_repeat(list(av[-1]), in_repeat):
+                return True
+        elif op == BRANCH:
+            for branch in av[1]:
+                if has_nested_repeat(list(branch), in_repeat):
+                    return True
+    return False
+
+
+class GuardedMatcher(object):
+
+    """Stands in for a compiled regex that could backtrack catastrophically.
+
+    Searches go through re2 if it's installed (and supports the pattern),
+    which always runs in linear time. Otherwise they're run in the watchdog
+    process, which raises MatchTimeout if one takes longer than the time
+    budget.
+    """
+
+    def __init__(self, pattern, compiled):
+        self.pattern = pattern
+        self.groups = compiled.groups
+        self.groupindex = compiled.groupindex
+        self.re2 = None
+        if re2 is not None:
+            try:
+                self.re2 = re2.compile(pattern, REGEX_FLAGS)
+            except Exception:
+                pass
+
+    def search(self, test_string):
+        if self.re2 is not None:
+            return self.re2.search(test_string)
+        return watchdog.search(self.pattern, test_string, time_budget)
+
+
+class Watchdog(object):
+
+    """Runs regex searches in a child process that can be killed.
+
+    If a search takes longer than its timeout, the child is killed (a new
+    one is started for the next search) and MatchTimeout is raised. Searches
+    are done one at a time, and the timeout only counts the search itself
+    (as timed by the child), not any wait for an earlier one to finish.
+    Where a child process can't be started (e.g. inside a multiprocessing
+    pool worker), searches run in this process and can't be cut short, but
+    still raise MatchTimeout if they took too long.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.process = None
+        self.conn = None
+        self.inline = False
+
+    def _start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=watchdog_loop,
+                                          args=(child_conn,))
+        process.daemon = True
+        try:
+            process.start()
+        except AssertionError:
+            # daemonic processes aren't allowed to have children
+            logging.warning('  Can\'t start a watchdog process, checking '
+                            'risky regexes without a time limit')
+            self.inline = True
+            return
+        child_conn.close()
+        self.process = process
+        self.conn = parent_conn
+
+    def _stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+        self.process = None
+
+    def search(self, pattern, test_string, timeout):
+        """Returns whether pattern matches test_string."""
+        with self.lock:
+            if self.process is None and not self.inline:
+                self._start()
+            if self.inline:
+                start_time = time()
+                matched = bool(re.search(pattern, test_string, REGEX_FLAGS))
+                seconds = time() - start_time
+            else:
+                matched, seconds = self._search(pattern, test_string, timeout)
+
+        if seconds > timeout:
+            raise MatchTimeout('search took %.3fs' % seconds)
+        return matched
+
+    def _search(self, pattern, test_string, timeout, retry=True):
+        try:
+            self.conn.send((pattern, test_string))
+            finished = self.conn.poll(timeout)
+            if finished:
+                return self.conn.recv()
+        except (EOFError, IOError, OSError):
+            # the child died some other way, start a new one. If that dies
+            # too, it's most likely this search that's killing it.
+            self._stop()
+            if not retry:
+                raise MatchTimeout('watchdog process died during search')
+            self._start()
+            return self._search(pattern, test_string, timeout, retry=False)
+
+        self._stop()
+        raise MatchTimeout('search took over %ss' % timeout)
+
+
+def watchdog_loop(conn):
+    """Runs in the watchdog process, answering searches until killed."""
+    compiled = dict()
+    while True:
+        try:
+            pattern, test_string = conn.recv()
+        except EOFError:
+            return
+        if pattern not in compiled:
+            compiled[pattern] = re.compile(pattern, REGEX_FLAGS)
+        start_time = time()
+        matched = bool(compiled[pattern].search(test_string))
+        conn.send((matched, time() - start_time))
+
+
+# the watchdog process shared by all GuardedMatchers
+watchdog = Watchdog()
+
+
+class LiteralSet(object):
+
+    """Index of literal strings that must match the whole test string."""
+
+    def __init__(self):
+        self.ids = dict()
+
+    def add(self, literals, condition_id):
+        for literal in literals:
+            self.ids.setdefault(literal, set()).add(condition_id)
+
+    def match_ids(self, test_string):
+        return self.ids.get(test_string, ())
+
+
+class SuffixTrie(object):
+
+    """Index of literal strings that the test string must end with.
+
+    Stored as a trie of the reversed strings, so a lookup costs the length of
+    the test string no matter how many suffixes there are.
+    """
+
+    def __init__(self):
+        self.root = dict()
+
+    def add(self, literals, condition_id):
+        for literal in literals:
+            node = self.root
+            for char in reversed(literal):
+                node = node.setdefault(char, dict())
+            node.setdefault(None, set()).add(condition_id)
+
+    def match_ids(self, test_string):
+        matched = set()
+        node = self.root
+        for char in reversed(test_string):
+            node = node.get(char)
+            if node is None:
+                break
+            matched.update(node.get(None, ()))
+        return matched
+
+
+class DomainTrie(object):
+
+    """Index of domains that the test string must equal or be a subdomain of.
+
+    Stored as a trie of reversed domain labels ("com" -> "example"), so a
+    lookup costs the number of labels in the test string.
+    """
+
+    def __init__(self):
+        self.root = dict()
+
+    def add(self, literals, condition_id):
+        for literal in literals:
+            node = self.root
+            for label in reversed(literal.split('.')):
+                node = node.setdefault(label, dict())
+            node.setdefault(None, set()).add(condition_id)
+
+    def match_ids(self, test_string):
+        matched = set()
+        node = self.root
+        for label in reversed(test_string.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            matched.update(node.get(None, ()))
+        return matched
+
+
+class LiteralMatcher(object):
+
+    """Stands in for a compiled regex whose value is a set of literals."""
+
+    groups = 0
+    groupindex = dict()
+
+    def __init__(self, index, literals):
+        self.index = index
+        self.index.add(literals, True)
+
+    def search(self, test_string):
+        for candidate in end_candidates(test_string):
+            if self.index.match_ids(candidate):
+                return True
+        return False
+
+
+def end_candidates(test_string):
+    """Returns the strings a literal lookup should try for a test string.
+
+    "$" also matches just before a trailing newline, so a string ending with
+    one has to be tried both with and without it.
+    """
+    if test_string.endswith('\n'):
+        return (test_string, test_string[:-1])
+    return (test_string,)
+
+
+def parse_literals(value):
+    """Checks if a condition value is really a finite set of literal strings.
+
+    Returns a tuple of (index class, set of strings) when the whole value is:
+        an alternation of literals, e.g. "(bit\.ly|goo\.gl)" - LiteralSet
+        .* followed by one, e.g. ".*(\.ru|\.cn)" - SuffixTrie
+        (.*\.)? followed by one, e.g. "(.*\.)?(foo\.com|bar\.net)" - DomainTrie
+    Returns None for anything else, which needs to stay a regex.
+    """
+    value = value.lower()
+    if has_top_level_branch(value):
+        # "^a|b$" isn't the same as "^(a|b)$"
+        return None
+
+    try:
+        parsed = sre_parse.parse(value, REGEX_FLAGS)
+    except Exception:
+        return None
+    if parsed.pattern.flags & ~(REGEX_FLAGS|re.IGNORECASE):
+        return None
+    items = list(parsed)
+
+    index_class = LiteralSet
+    if items and is_any_repeat(items[0]):
+        index_class = SuffixTrie
+        items = items[1:]
+    elif (items and items[0][0] == MAX_REPEAT and
+            items[0][1][:2] == (0, 1) and
+            len(items[0][1][2]) == 1 and
+            items[0][1][2][0][0] == SUBPATTERN):
+        optional = list(items[0][1][2][0][1][-1])
+        if (len(optional) == 2 and is_any_repeat(optional[0]) and
+                optional[1] == (LITERAL, ord('.'))):
+            index_class = DomainTrie
+            items = items[1:]
+
+    strings = expand_literals(items)
+    if not strings or '' in strings:
+        return None
+    return (index_class, strings)
+
+
+def trivial_match(value):
+    """Checks if a condition value matches without needing a search.
+
+    Returns "any" if the value matches every string (e.g. ".*"), "empty" if
+    it only matches the empty string, or None for anything else.
+    """
+    if has_top_level_branch(value):
+        return None
+    try:
+        parsed = sre_parse.parse(value.lower(), REGEX_FLAGS)
+    except Exception:
+        return None
+    if parsed.pattern.flags & ~(REGEX_FLAGS|re.IGNORECASE):
+        return None
+    items = list(parsed)
+    # a group around the whole value doesn't change what it matches
+    while len(items) == 1 and items[0][0] == SUBPATTERN:
+        items = list(items[0][1][-1])
+
+    if not items:
+        return 'empty'
+    if len(items) == 1 and is_any_repeat(items[0]):
+        return 'any'
+    return None
+
+
+def is_any_repeat(item):
+    """Returns True if a parsed regex item is ".*" (or ".*?")."""
+    op, av = item
+    return (op in (MAX_REPEAT, MIN_REPEAT) and
+            av[0] == 0 and av[1] == MAXREPEAT and
+            list(av[2]) == [(ANY, None)])
+
+
+def expand_literals(items):
+    """Returns the set of strings a parsed regex sequence can match.
+
+    Returns None if the sequence can match anything other than a small,
+    finite set of literals.
+    """
+    strings = set([u''])
+    for op, av in items:
+        if op == LITERAL:
+            choices = set([unichr(av)])
+        elif op == IN:
+            choices = set()
+            for in_op, in_av in av:
+                if in_op != LITERAL:
+                    return None
+                choices.add(unichr(in_av))
+        elif op == BRANCH:
+            choices = set()
+            for branch in av[1]:
+                branch_strings = expand_literals(branch)
+                if branch_strings is None:
+                    return None
+                choices.update(branch_strings)
+        elif op == SUBPATTERN:
+            choices = expand_literals(av[-1])
+        elif op in (MAX_REPEAT, MIN_REPEAT) and av[:2] == (0, 1):
+            choices = expand_literals(av[2])
+            if choices is not None:
+                choices.add(u'')
+        else:
+            return None
+
+        if choices is None:
+            return None
+        strings = set(s+c for s in strings for c in choices)
+        if len(strings) > MAX_LITERALS:
+            return None
+    return strings
+
+
+def has_top_level_branch(value):
+    """Returns True if a regex has a "|" that isn't inside any group."""
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(value):
+        char = value[i]
+        if char == '\\':
+            i += 1
+        elif in_class:
+            if char == ']':
+                in_class = False
+        elif char == '[':
+            in_class = True
+            # a ] right after the opening [ (or [^) is a literal
+            if value[i+1:i+2] == '^':
+                i += 1
+            if value[i+1:i+2] == ']':
+                i += 1
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == '|' and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+class MultiMatcher(object):
+
+    """Matches a string against the regexes of many conditions at once.
+
+    All the conditions are combined into a single alternation with one named
+    group per condition, so a string that doesn't match any of them (the
+    usual case) is rejected in a single pass. When the combined regex does
+    match, the named group identifies one matching condition and only the
+    remaining ones need to be verified individually.
+
+    Conditions with literal-set values go into shared LiteralSet/SuffixTrie/
+    DomainTrie indexes instead, which report every matching id directly, and
+    ones that match anything (".*") or only the empty string don't need a
+    search at all.
+
+    Alternatives are tried in order, so when a chunk matches, none of the
+    conditions before the one that matched can. Only the ones after it are
+    checked again, with another search of just those alternatives.
+
+    Conditions whose values use backreferences, named groups, inline flags or
+    a top-level "|" can't be safely combined, and neither can risky ones
+    (which need their own GuardedMatcher), so they're left for the caller to
+    check normally.
+    """
+
+    # python's re module can't handle more than 100 groups per pattern
+    MAX_GROUPS = 99
+
+    def __init__(self, conditions):
+        self.conditions = dict()
+        self.chunks = list()
+        self.indexes = dict()
+        self.match_any = set()
+        self.match_empty = set()
+
+        patterns = list()
+        groups = 0
+        for condition in conditions:
+            if condition.id is None:
+                continue
+
+            trivial = trivial_match(condition.value)
+            if trivial == 'any':
+                self.match_any.add(condition.id)
+                self.conditions[condition.id] = condition
+                continue
+            elif trivial == 'empty':
+                self.match_empty.add(condition.id)
+                self.conditions[condition.id] = condition
+                continue
+
+            if isinstance(get_matcher(condition), LiteralMatcher):
+                index_class, strings = parse_literals(condition.value)
+                if index_class not in self.indexes:
+                    self.indexes[index_class] = index_class()
+                self.indexes[index_class].add(strings, condition.id)
+                self.conditions[condition.id] = condition
+                continue
+
+            if not can_combine(condition):
+                continue
+
+            # one group per condition, plus any groups inside its value
+            needed = get_matcher(condition).groups + 1
+            if patterns and groups + needed > self.MAX_GROUPS:
+                self._add_chunk(patterns)
+                patterns = list()
+                groups = 0
+            patterns.append((condition.id, '(?P<c%s>^%s$)'
+                             % (condition.id, condition.value.lower())))
+            groups += needed
+            self.conditions[condition.id] = condition
+        if patterns:
+            self._add_chunk(patterns)
+
+    def _add_chunk(self, patterns):
+        # the compiled alternation of the patterns from each start position,
+        # the later ones are only compiled once something matches before them
+        positions = dict((condition_id, i)
+                         for i, (condition_id, _) in enumerate(patterns))
+        self.chunks.append((patterns, positions, dict()))
+
+    def _compiled(self, chunk, start):
+        patterns, _, compiled = chunk
+        if start not in compiled:
+            compiled[start] = re.compile(
+                '|'.join(p for _, p in patterns[start:]), REGEX_FLAGS)
+        return compiled[start]
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def covers(self, condition):
+        """Returns True if the condition is part of this matcher."""
+        return condition.id in self.conditions
+
+    def match(self, test_string):
+        """Returns the set of condition ids whose regex matches the string."""
+        matched = set(self.match_any)
+        if self.match_empty and '' in end_candidates(test_string):
+            matched.update(self.match_empty)
+        for index in self.indexes.values():
+            for candidate in end_candidates(test_string):
+                matched.update(index.match_ids(candidate))
+
+        for chunk in self.chunks:
+            patterns, positions, _ = chunk
+            start = 0
+            while start < len(patterns):
+                match = self._compiled(chunk, start).search(test_string)
+                if not match:
+                    break
+                condition_id = int(match.lastgroup[1:])
+                matched.add(condition_id)
+                start = positions[condition_id] + 1
+        return matched
+
+
+class ItemMatches(object):
+
+    """Lazily runs one item's attributes through a set of MultiMatchers.
+
+    matchers - dict of attribute name to MultiMatcher
+    get_string - function returning the item's (lowercased) test string for
+        an attribute name
+    """
+
+    def __init__(self, matchers, get_string):
+        self.matchers = matchers
+        self.get_string = get_string
+        self.results = dict()
+
+    def covers(self, condition):
+        """Returns True if the condition's regex result comes from here."""
+        matcher = self.matchers.get(condition.attribute)
+        return matcher is not None and matcher.covers(condition)
+
+    def matched(self, condition):
+        """Returns whether the condition's regex matched the item."""
+        attribute = condition.attribute
+        if attribute not in self.results:
+            self.results[attribute] = (self.matchers[attribute]
+                                       .match(self.get_string(attribute)))
+        return condition.id in self.results[attribute]
+
+
+def can_combine(condition):
+    """Returns True if a condition's value can go in a MultiMatcher."""
+    matcher = get_matcher(condition)
+    if matcher.groupindex or isinstance(matcher, GuardedMatcher):
+        return False
+    if re.search(r'\\\d|\(\?P=|\(\?\(|\(\?[aiLmsux]', condition.value):
+        return False
+    # "^a|b$" can match away from the start of the string, so it could
+    # match where an earlier alternative in the chunk also does
+    if has_top_level_branch(condition.value):
+        return False
+    return True
+
+
+def build_multi_matchers(conditions):
+    """Groups conditions by attribute and builds a MultiMatcher for each.
+
+    Returns a dict of attribute name to MultiMatcher, only including
+    attributes where at least two conditions could be combined.
+    """
+    by_attribute = dict()
+    for condition in conditions:
+        by_attribute.setdefault(condition.attribute, list()).append(condition)
+
+    matchers = dict()
+    for attribute, attr_conditions in by_attribute.items():
+        matcher = MultiMatcher(attr_conditions)
+        if len(matcher) >= 2:
+            matchers[attribute] = matcher
+    return matchers
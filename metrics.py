@@ -0,0 +1,177 @@
+import os
+import json
+import threading
+from contextlib import contextmanager
+from time import time
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Histogram(object):
+
+    """Counts observed values into cumulative buckets, Prometheus-style."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def as_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'buckets': dict(zip([str(b) for b in self.buckets],
+                                    self.counts))}
+
+
+class Metrics(object):
+
+    """Collects counters, gauges and histograms, keyed by name and labels.
+
+    Everything accumulates for the life of the process, and can be written
+    out as a Prometheus text file or as JSON with write().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.context = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets a gauge to value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        """Adds a value to a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes how long the with block took in a histogram."""
+        start_time = time()
+        try:
+            yield
+        finally:
+            self.observe(name, time() - start_time, **labels)
+
+    def get_label(self, name, default=None):
+        """Returns a label set for the current thread with set_label()."""
+        return getattr(self.context, name, default)
+
+    def set_label(self, name, value):
+        """Sets a label for whatever the current thread does next.
+
+        Used for things like counting requests per queue, where the code
+        doing the counting doesn't know which queue it's working for.
+        """
+        setattr(self.context, name, value)
+
+    def to_prometheus(self):
+        """Returns everything in the Prometheus text exposition format."""
+        lines = list()
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append('%s%s %s' % (name, format_labels(labels), value))
+            for (name, labels), hist in sorted(self.histograms.items()):
+                for bound, count in zip(hist.buckets, hist.counts):
+                    lines.append('%s_bucket%s %s' % (name,
+                        format_labels(labels + (('le', bound),)), count))
+                lines.append('%s_bucket%s %s' % (name,
+                    format_labels(labels + (('le', '+Inf'),)), hist.count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels),
+                                              hist.sum))
+                lines.append('%s_count%s %s' % (name, format_labels(labels),
+                                                hist.count))
+        return '\n'.join(lines)+'\n'
+
+    def to_json(self):
+        """Returns everything as a JSON string."""
+        def entries(items, convert=lambda v: v):
+            return [{'name': name, 'labels': dict(labels),
+                     'value': convert(value)}
+                    for (name, labels), value in sorted(items)]
+        with self.lock:
+            return json.dumps({
+                'time': time(),
+                'counters': entries(self.counters.items()),
+                'gauges': entries(self.gauges.items()),
+                'histograms': entries(self.histograms.items(),
+                                      lambda h: h.as_dict()),
+            }, indent=2)
+
+    def write(self, path):
+        """Writes the metrics to path, as JSON if it ends in .json.
+
+        The file is replaced atomically, so anything reading it (like the
+        Prometheus node exporter's textfile collector) never sees half of it.
+        """
+        if path.endswith('.json'):
+            content = self.to_json()
+        else:
+            content = self.to_prometheus()
+        temp_path = path+'.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(content)
+        os.rename(temp_path, path)
+
+
+def timed_iter(iterable, totals, key):
+    """Yields from iterable, adding the time spent waiting to totals[key].
+
+    Useful for listing generators, where the time spent fetching pages is
+    hidden inside the iteration.
+    """
+    iterator = iter(iterable)
+    while True:
+        start_time = time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            totals[key] += time() - start_time
+        yield item
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label(value))
+                             for name, value in labels)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+# the bot's metrics
+metrics = Metrics()
@@ -0,0 +1,105 @@
+"""Brings an existing database's schema up to date with models.py.
+
+Creates any missing tables, adds missing nullable columns to existing
+tables, and creates any indexes declared on the models that don't exist
+yet. Existing data is never touched, so it's safe to run after every
+upgrade:
+
+    python migrate.py [--dry-run]
+"""
+import argparse
+import logging
+
+from sqlalchemy.engine.reflection import Inspector
+
+from models import db
+
+
+def migrate(engine, metadata, dry_run=False):
+    """Adds whatever is missing from the database. Returns the changes."""
+    inspector = Inspector.from_engine(engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = list()
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables:
+            changes.append('create table %s' % table.name)
+            if not dry_run:
+                # also creates the table's indexes
+                table.create(bind=engine)
+            continue
+
+        existing_columns = set(c['name']
+                               for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            if not column.nullable and column.server_default is None:
+                logging.warning('Can\'t add non-null column %s.%s without a '
+                                'default, add it manually',
+                                table.name, column.name)
+                continue
+            changes.append('add column %s.%s' % (table.name, column.name))
+            if not dry_run:
+                add_column(engine, table, column)
+
+        existing_indexes = set(i['name']
+                               for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            changes.append('create index %s' % index.name)
+            if not dry_run:
+                create_index(engine, index)
+
+    return changes
+
+
+def add_column(engine, table, column):
+    engine.execute('ALTER TABLE %s ADD COLUMN %s %s'
+                   % (table.name,
+                      column.name,
+                      column.type.compile(dialect=engine.dialect)))
+
+
+def create_index(engine, index):
+    """Creates an index, without blocking writes on PostgreSQL.
+
+    Indexes on big tables like action_log can take a while to build, so on
+    PostgreSQL they're built CONCURRENTLY, which can't be done inside a
+    transaction.
+    """
+    if engine.dialect.name != 'postgresql':
+        index.create(bind=engine)
+        return
+
+    conn = engine.raw_connection()
+    try:
+        conn.set_isolation_level(0)
+        cursor = conn.cursor()
+        cursor.execute('CREATE %sINDEX CONCURRENTLY %s ON %s (%s)'
+                       % ('UNIQUE ' if index.unique else '',
+                          index.name,
+                          index.table.name,
+                          ', '.join(c.name for c in index.columns)))
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Updates the database schema to match models.py.')
+    parser.add_argument('--dry-run', action='store_true',
+        help='only list the changes that would be made')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    changes = migrate(db.engine, db.metadata, args.dry_run)
+    for change in changes:
+        logging.info(change)
+    if not changes:
+        logging.info('Database is up to date')
+
+
+if __name__ == '__main__':
+    main()
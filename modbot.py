@@ -1,27 +1,114 @@
+from time import time, sleep
+# how long importing everything takes is reported in main()
+import_start = time()
+
 import re
+import argparse
+import heapq
+import threading
 import logging, logging.config
 import urllib2
+from collections import namedtuple
 from datetime import datetime, timedelta
-from time import time
+from itertools import takewhile
+from multiprocessing.pool import ThreadPool
+from calendar import timegm
+from HTMLParser import HTMLParser
 
 import reddit
-from BeautifulSoup import BeautifulSoup
 from sqlalchemy import func
-from sqlalchemy.sql import and_
-from sqlalchemy.orm.exc import NoResultFound
-
-from models import cfg_file, path_to_cfg, db, Subreddit, Condition, \
-    ActionLog, AutoReapproval
+from sqlalchemy.sql import and_, select
+from sqlalchemy.exc import IntegrityError
+
+from models import cfg_file, path_to_cfg, cfg_option, db, Subreddit, \
+    Condition, ActionLog, AutoReapproval, RedditorCache, ShadowbanCache, \
+    MemeCache, QueueCursor
+from caches import TTLCache
+from httppool import ConnectionPool
+from metrics import metrics, timed_iter
+import ratelimit
+import matching
+from leases import LeaseManager, default_worker_id
+from condition_stats import ConditionStatsTracker
+from matching import get_matcher, compile_conditions, build_multi_matchers, \
+    retain_matchers, ItemMatches, GuardedMatcher, MatchTimeout
+
+import_seconds = time() - import_start
 
 # global reddit session
 r = None
 
+# profile info and shadowban verdicts for recently-checked redditors,
+# set up in main()
+redditor_cache = None
+shadowban_cache = None
+
+RedditorInfo = namedtuple('RedditorInfo',
+    ['link_karma', 'comment_karma', 'created_utc', 'is_gold'])
+
+# the newest item seen in a subreddit's queue, see load_cursors()
+Cursor = namedtuple('Cursor', ['fullname', 'created_utc', 'item_rate'])
+
+# meme names by page URL, and the connections used to load meme pages
+meme_cache = None
+meme_pool = None
+
+# performs actions and writes their ActionLog entries, set up in main()
+action_executor = None
+
+# how each condition has done when checked, used to decide what order
+# they're checked in
+condition_stats = ConditionStatsTracker()
+
+# conditions need to have been checked this many times before their stats
+# are used for ordering them
+MIN_EVALUATIONS = 20
+
+# claims this worker's share of the subreddits when running sharded, set up
+# in main()
+lease_manager = None
+
 # don't remove/approve any reports older than this (doesn't apply to alerts)
 REPORT_BACKLOG_LIMIT = timedelta(days=2)
 
+# the queues items are checked from, and the subjects conditions can apply to
+QUEUES = ('report', 'spam', 'submission', 'comment')
+SUBJECTS = ('submission', 'comment')
+
+# how many pages of new items are read forwards from a cursor in one check,
+# anything newer is left for the next check
+MAX_NEW_PAGES = 10
+
 
 def perform_action(subreddit, item, condition):
-    """Performs the action for the condition(s) and creates an ActionLog entry."""
+    """Performs the action for the condition(s) and logs it.
+
+    Goes through the ActionExecutor if one has been set up, otherwise the
+    action is performed and logged immediately.
+    """
+    global action_executor
+    if action_executor:
+        action_executor.submit(subreddit, item, condition)
+    else:
+        with ratelimit.priority(action_priority(condition)):
+            log_entry = do_action(subreddit, item, condition)
+        db.engine.execute(ActionLog.__table__.insert(), [log_entry])
+
+
+def action_priority(condition):
+    """Returns the request priority for the condition(s)'s action."""
+    if isinstance(condition, list):
+        condition = condition[0]
+    if condition.action in ('remove', 'alert'):
+        return ratelimit.PRIORITY_REMOVAL
+    return ratelimit.PRIORITY_APPROVAL
+
+
+def do_action(subreddit, item, condition):
+    """Performs the action for the condition(s).
+
+    Returns a dict of the values for the action's ActionLog entry.
+    """
     global r
 
     # post the comment if one is set
@@ -52,40 +139,154 @@ def perform_action(subreddit, item, condition):
             'The following item has received a large number of reports, '+
             'please investigate:\n\n'+item)
 
-    # log the action taken
-    action_log = ActionLog()
-    action_log.subreddit_id = subreddit.id
-    action_log.action_time = datetime.utcnow()
-    action_log.action = condition.action
+    # log the action taken, every column is included so that entries can be
+    # inserted together in one statement
+    log_entry = dict((c.name, None) for c in ActionLog.__table__.columns
+                     if c.name != 'id')
+    log_entry['subreddit_id'] = subreddit.id
+    log_entry['action_time'] = datetime.utcnow()
+    log_entry['action'] = condition.action
 
     if isinstance(item, str) or isinstance(item, unicode):
         # for report threshold alert, we only know permalink to item
-        action_log.permalink = item
+        log_entry['permalink'] = item
     else:
-        action_log.user = item.author.name
-        action_log.created_utc = datetime.utcfromtimestamp(item.created_utc)
-        action_log.matched_condition = condition.id
+        log_entry['user'] = item.author.name
+        log_entry['created_utc'] = datetime.utcfromtimestamp(item.created_utc)
+        log_entry['matched_condition'] = condition.id
 
     if isinstance(item, reddit.objects.Submission):
-        action_log.title = item.title
-        action_log.permalink = item.permalink
-        action_log.url = item.url
-        action_log.domain = item.domain
+        log_entry['title'] = item.title
+        log_entry['permalink'] = item.permalink
+        log_entry['url'] = item.url
+        log_entry['domain'] = item.domain
         logging.info('  /r/%s: %sd submission "%s"',
                         subreddit.name,
                         condition.action,
                         item.title.encode('ascii', 'ignore'))
     elif isinstance(item, reddit.objects.Comment):
-        action_log.permalink = ('http://www.reddit.com/r/'+
-                                item.subreddit.display_name+
-                                '/comments/'+item.link_id.split('_')[1]+
-                                '/a/'+item.id)
+        log_entry['permalink'] = ('http://www.reddit.com/r/'+
+                                  item.subreddit.display_name+
+                                  '/comments/'+item.link_id.split('_')[1]+
+                                  '/a/'+item.id)
         logging.info('        %sd comment by user %s',
                         condition.action,
                         item.author.name)
 
-    db.session.add(action_log)
-    db.session.commit()
+    return log_entry
+
+
+class ActionExecutor(object):
+
+    """Performs actions in a pool of worker threads and logs them in batches.
+
+    Matching items are handed off with submit() so checking can carry on
+    while the reddit requests for the actions are in flight. The ActionLog
+    entries are collected and inserted together once batch_size of them are
+    waiting or flush_interval seconds have passed since the last insert.
+
+    workers - How many actions can be performed at once. With 0, actions are
+        performed immediately in the calling thread (logs are still batched)
+    max_pending - How many actions can be queued up before submit() blocks
+    """
+
+    def __init__(self, workers, batch_size, flush_interval, max_pending=None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pool = None
+        if workers > 0:
+            self.pool = ThreadPool(workers)
+            self.slots = threading.Semaphore(max_pending or workers * 10)
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.log_entries = list()
+        self.log_lock = threading.Lock()
+        self.last_flush = time()
+
+    def submit(self, subreddit, item, condition):
+        """Queues up the action for the condition(s) on an item."""
+        if not self.pool:
+            self._perform(subreddit, item, condition)
+            return
+
+        self.slots.acquire()
+        with self.idle:
+            self.pending += 1
+        self.pool.apply_async(self._perform, (subreddit, item, condition))
+
+    def _perform(self, subreddit, item, condition):
+        metrics.set_label('queue', 'actions')
+        try:
+            with metrics.timer('modbot_stage_seconds', stage='act',
+                               queue='actions'):
+                with ratelimit.priority(action_priority(condition)):
+                    log_entry = do_action(subreddit, item, condition)
+            self.add_log_entry(log_entry)
+        except Exception as e:
+            logging.error('  ERROR: %s', e)
+        finally:
+            if self.pool:
+                self.slots.release()
+                with self.idle:
+                    self.pending -= 1
+                    self.idle.notify_all()
+
+    def add_log_entry(self, log_entry):
+        """Adds an ActionLog entry, inserting the batch if it's time to."""
+        with self.log_lock:
+            self.log_entries.append(log_entry)
+            due = (len(self.log_entries) >= self.batch_size or
+                   time() - self.last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Inserts all the waiting ActionLog entries.
+
+        If the insert fails, the entries are kept to be tried again with the
+        next flush, since they're what stops the actions being repeated.
+        """
+        with self.log_lock:
+            log_entries = self.log_entries
+            self.log_entries = list()
+            self.last_flush = time()
+        if not log_entries:
+            return
+        try:
+            with metrics.timer('modbot_stage_seconds', stage='log_flush',
+                               queue='actions'):
+                db.engine.execute(ActionLog.__table__.insert(), log_entries)
+        except Exception:
+            with self.log_lock:
+                self.log_entries = log_entries + self.log_entries
+            raise
+
+    def flush_if_due(self):
+        """Flushes if it's been flush_interval seconds since the last one.
+
+        For callers that are idle, since adding entries is what normally
+        triggers the time-based flush.
+        """
+        with self.log_lock:
+            due = (self.log_entries and
+                   time() - self.last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def wait(self):
+        """Waits for all the queued actions to finish, then flushes the log."""
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+        self.flush()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self.pool:
+                self.pool.close()
+                self.pool.join()
 
 
 def post_comment(item, comment):
@@ -103,106 +304,195 @@ def post_comment(item, comment):
         response.distinguish()
 
 
+class ReportsPageParser(HTMLParser):
+
+    """Pulls the reported items out of the reports page HTML as it's fed.
+
+    Only keeps track of what's needed from each item ("thing") on the page:
+    the permalink (from the first button), the number of reports (from the
+    reported stamp) and who approved it (from the approval checkmark), if
+    anyone. Completed items are collected in results as tuples of
+    (permalink, subreddit name, number of reports, approver).
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.results = list()
+        self.thing = None
+        self.depth = 0
+        self.stamp_tag = None
+        self.in_first_li = False
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+
+        if tag == 'div':
+            if self.thing is not None:
+                self.depth += 1
+            elif 'thing' in classes:
+                self.thing = {'permalink': None,
+                              'stamp': list(),
+                              'approver': None}
+                self.depth = 1
+            return
+        if self.thing is None:
+            return
+
+        if 'reported-stamp' in classes:
+            self.stamp_tag = tag
+        elif tag == 'li' and 'first' in classes:
+            self.in_first_li = True
+        elif (tag == 'a' and self.in_first_li and
+                self.thing['permalink'] is None):
+            self.thing['permalink'] = attrs.get('href')
+        elif 'approval-checkmark' in classes:
+            matches = re.search('approved by (.+)$', attrs.get('title', ''))
+            if matches:
+                self.thing['approver'] = matches.group(1)
+
+    def handle_endtag(self, tag):
+        if tag == self.stamp_tag:
+            self.stamp_tag = None
+        elif tag == 'li':
+            self.in_first_li = False
+        elif tag == 'div' and self.thing is not None:
+            self.depth -= 1
+            if self.depth == 0:
+                self._finish_thing()
+
+    def handle_data(self, data):
+        if self.stamp_tag:
+            self.thing['stamp'].append(data)
+
+    def _finish_thing(self):
+        thing = self.thing
+        self.thing = None
+        self.stamp_tag = None
+        self.in_first_li = False
+
+        reports = re.search('(\d+)\s*$', ''.join(thing['stamp']))
+        permalink = thing['permalink']
+        if not reports or not permalink:
+            return
+        sub_name = re.search('^http://www.reddit.com/r/([^/]+)', permalink)
+        if not sub_name:
+            return
+        self.results.append((permalink,
+                             sub_name.group(1).lower(),
+                             int(reports.group(1)),
+                             thing['approver']))
+
+
+def parse_reports_page(page, chunk_size=65536):
+    """Yields (permalink, subreddit name, reports, approver) for each item.
+
+    approver is None for items that haven't been approved.
+    """
+    parser = ReportsPageParser()
+    for start in range(0, len(page), chunk_size):
+        parser.feed(page[start:start+chunk_size])
+        for result in parser.results:
+            yield result
+        parser.results = list()
+    parser.close()
+    for result in parser.results:
+        yield result
+
+
 def check_reports_html(sr_dict):
     """Does report alerts/reapprovals, requires loading HTML page."""
     global r
 
     logging.info('Checking reports html page')
-    reports_page = r._request('http://www.reddit.com/r/mod/about/reports')
-    soup = BeautifulSoup(reports_page)
-
-    # check for report alerts
-    for reported_item in soup.findAll(
-            attrs={'class': 'rounded reported-stamp stamp'}):
-        permalink = (reported_item.parent
-                     .findAll('li', attrs={'class': 'first'})[0].a['href'])
-        sub_name = re.search('^http://www.reddit.com/r/([^/]+)',
-                    permalink).group(1).lower()
-        try:
-            subreddit = sr_dict[sub_name]
-        except KeyError:
-            continue
-
-        if not subreddit.report_threshold:
-            continue
-
-        reports = re.search('(\d+)$', reported_item.text).group(1)
-        if int(reports) >= subreddit.report_threshold:
-            try:
-                # check log to see if this item has already had an alert
-                ActionLog.query.filter(
-                    and_(ActionLog.subreddit_id == subreddit.id,
-                         ActionLog.permalink == permalink,
-                         ActionLog.action == 'alert')).one()
-            except NoResultFound:
-                c = Condition()
-                c.action = 'alert'
-                perform_action(subreddit, permalink, c)
-
-    # do auto-reapprovals
-    for approved_item in soup.findAll(
-            attrs={'class': 'approval-checkmark'}):
-        report_stamp = approved_item.parent.parent.findAll(
-                        attrs={'class': 'rounded reported-stamp stamp'})[0]
-
-        permalink = (report_stamp.parent
-                     .findAll('li', attrs={'class': 'first'})[0].a['href'])
-        sub_name = re.search('^http://www.reddit.com/r/([^/]+)',
-                    permalink).group(1).lower()
-        try:
-            subreddit = sr_dict[sub_name]
-        except KeyError:
-            continue
-
-        if not subreddit.auto_reapprove:
+    reports_page = r._request('http://www.reddit.com/r/%s/about/reports'
+                              % listing_name(sr_dict.values()))
+    reported = [item for item in parse_reports_page(reports_page)
+                if item[1] in sr_dict]
+    if not reported:
+        return
+
+    # load which items have already been alerted and reapproved at once
+    permalinks = set(item[0] for item in reported)
+    sr_ids = set(sr_dict[item[1]].id for item in reported)
+    alerted = set(db.session.query(ActionLog.subreddit_id, ActionLog.permalink)
+                    .filter(and_(ActionLog.action == 'alert',
+                                 ActionLog.subreddit_id.in_(sr_ids),
+                                 ActionLog.permalink.in_(permalinks))))
+    reapprovals = dict(((e.subreddit_id, e.permalink), e)
+                       for e in AutoReapproval.query.filter(
+                            and_(AutoReapproval.subreddit_id.in_(sr_ids),
+                                 AutoReapproval.permalink.in_(permalinks))))
+    username = cfg_file.get('reddit', 'username').lower()
+
+    for permalink, sub_name, num_reports, approver in reported:
+        subreddit = sr_dict[sub_name]
+        key = (subreddit.id, permalink)
+
+        # check for report alerts
+        if (subreddit.report_threshold and
+                num_reports >= subreddit.report_threshold and
+                key not in alerted):
+            alerted.add(key)
+            c = Condition()
+            c.action = 'alert'
+            perform_action(subreddit, permalink, c)
+
+        # do auto-reapprovals
+        if not approver or not subreddit.auto_reapprove:
             continue
 
-        num_reports = re.search('(\d+)$', report_stamp.text).group(1)
-        num_reports = int(num_reports)
-
-        try:
-            # see if this item has already been auto-reapproved
-            entry = (AutoReapproval.query.filter(
-                        and_(AutoReapproval.subreddit_id == subreddit.id,
-                             AutoReapproval.permalink == permalink))
-                        .one())
-            in_db = True
-        except NoResultFound:
+        # see if this item has already been auto-reapproved
+        entry = reapprovals.get(key)
+        in_db = entry is not None
+        if not in_db:
             entry = AutoReapproval()
             entry.subreddit_id = subreddit.id
             entry.permalink = permalink
-            entry.original_approver = (re.search('approved by (.+)$',
-                                                 approved_item['title'])
-                                       .group(1))
+            entry.original_approver = approver
             entry.total_reports = 0
             entry.first_approval_time = datetime.utcnow()
-            in_db = False
 
-        if (in_db or
-                approved_item['title'].lower() != \
-                'approved by '+cfg_file.get('reddit', 'username').lower()):
-            sub = r.get_submission(permalink)
-            sub.approve()
+        if in_db or approver.lower() != username:
+            with ratelimit.priority(ratelimit.PRIORITY_APPROVAL):
+                sub = r.get_submission(permalink)
+                sub.approve()
             entry.total_reports += num_reports
             entry.last_approval_time = datetime.utcnow()
 
+            # committed right away, so an error further down the page can't
+            # lose the record of an approval that's already been done
             db.session.add(entry)
             db.session.commit()
+            reapprovals[key] = entry
             logging.info('    Re-approved %s', entry.permalink)
 
 
-def check_items(name, items, sr_dict, stop_time):
-    """Checks the items generator for any matching conditions."""
+def check_items(name, items, sr_dict, stop_time, snapshot, modqueue=None,
+                cursors=None):
+    """Checks the items generator for any matching conditions.
+
+    For the spam queue, modqueue must be a ModqueueIndex, and only items that
+    are still in the modqueue are checked.
+
+    If cursors (from load_cursors()) is given, items that aren't newer than
+    their subreddit's cursor are skipped, and the cursors are moved up to the
+    newest item seen in each subreddit.
+
+    Returns the number of items that were checked.
+    """
     item_count = 0
     skip_count = 0
     skip_subs = set()
     start_time = time()
-    seen_subs = set()
+    newest = dict()
+    new_counts = dict()
+    stage_times = {'fetch': 0.0, 'evaluate': 0.0, 'commit': 0.0}
 
     logging.info('Checking new %ss', name)
 
     try:
-        for item in items:
+        for item in timed_iter(items, stage_times, 'fetch'):
             item_time = datetime.utcfromtimestamp(item.created_utc)
             if item_time <= stop_time:
                 break
@@ -214,34 +504,239 @@ def check_items(name, items, sr_dict, stop_time):
                 skip_subs.add(item.subreddit.display_name.lower())
                 continue
 
-            conditions = (subreddit.conditions
-                            .filter(Condition.parent_id == None)
-                            .all())
-            conditions = filter_conditions(name, conditions)
-
-            if name != 'spam' or in_modqueue(item):
-                if not check_conditions(subreddit, item,
-                        [c for c in conditions if c.action == 'remove']):
-                    check_conditions(subreddit, item,
-                            [c for c in conditions if c.action == 'approve'])
+            # already seen by an earlier check
+            if cursors and subreddit.id in cursors:
+                if item_time <= cursors[subreddit.id].created_utc:
+                    continue
+
+            if name == 'spam':
+                fetch_start = time()
+                in_modqueue = item in modqueue
+                stage_times['fetch'] += time() - fetch_start
+
+            if name != 'spam' or in_modqueue:
+                evaluate_start = time()
+                key = (subreddit.name.lower(), get_subject(item))
+                matchers = snapshot.get(key)
+                view = ItemView(item)
+                if not check_conditions(subreddit, view,
+                        snapshot.get((key[0], name, key[1], 'remove'), ()),
+                        matchers):
+                    check_conditions(subreddit, view,
+                        snapshot.get((key[0], name, key[1], 'approve'), ()),
+                        matchers)
+                stage_times['evaluate'] += time() - evaluate_start
 
             item_count += 1
 
-            if subreddit.name not in seen_subs:
-                setattr(subreddit, 'last_'+name, item_time)
-                seen_subs.add(subreddit.name)
+            if subreddit.id not in newest:
+                newest[subreddit.id] = (item.name, item_time)
+            new_counts[subreddit.id] = new_counts.get(subreddit.id, 0) + 1
 
+        commit_start = time()
+        if cursors is not None:
+            save_cursors(name, newest, new_counts)
         db.session.commit()
+        stage_times['commit'] += time() - commit_start
     except Exception as e:
         logging.error('  ERROR: %s', e)
         db.session.rollback()
 
+    for stage, seconds in stage_times.items():
+        metrics.observe('modbot_stage_seconds', seconds,
+                        stage=stage, queue=name)
+    metrics.inc('modbot_items_checked', item_count, queue=name)
+    metrics.inc('modbot_items_skipped', skip_count, queue=name)
+
     logging.info('  Checked %s items, skipped %s items in %s (skips: %s)',
             item_count, skip_count, elapsed_since(start_time),
             ', '.join(skip_subs))
+    return item_count
+
+
+def load_cursors(name, subreddits):
+    """Returns the subreddits' cursors for a queue.
+
+    The result is a dict of subreddit id to Cursor. Subreddits without a
+    cursor yet start from their last_<queue> time, with no fullname and an
+    unknown item rate.
+    """
+    cursors = dict((s.id, Cursor(None, getattr(s, 'last_'+name), None))
+                   for s in subreddits)
+    for cursor in QueueCursor.query.filter(and_(
+            QueueCursor.queue == name,
+            QueueCursor.subreddit_id.in_(cursors.keys()))):
+        cursors[cursor.subreddit_id] = Cursor(cursor.fullname,
+                                              cursor.created_utc,
+                                              cursor.item_rate)
+    return cursors
+
+
+def save_cursors(name, newest, new_counts):
+    """Moves a queue's cursors up to the newest items seen.
+
+    newest is a dict of subreddit id to (fullname, created_utc), and
+    new_counts how many new items each subreddit had, which goes into its
+    item rate. The changes are made through this thread's session (rather
+    than the subreddit objects, which may belong to another thread's
+    session) and need to be committed.
+    """
+    if not newest:
+        return
+    now = datetime.utcnow()
+    existing = dict((row.subreddit_id, row) for row in
+                    db.session.query(QueueCursor.subreddit_id,
+                                     QueueCursor.updated_time,
+                                     QueueCursor.item_rate)
+                        .filter(and_(
+                            QueueCursor.queue == name,
+                            QueueCursor.subreddit_id.in_(newest.keys()))))
+
+    for subreddit_id, (fullname, created_utc) in newest.items():
+        # keep the old column up to date too, it's what new cursors start from
+        (db.session.query(Subreddit)
+            .filter(Subreddit.id == subreddit_id)
+            .update({'last_'+name: created_utc}, synchronize_session=False))
+
+        if subreddit_id in existing:
+            row = existing[subreddit_id]
+            # the time since the cursor last moved covers all these items
+            hours = max(total_seconds(now - row.updated_time), 60) / 3600.0
+            item_rate = new_counts.get(subreddit_id, 0) / hours
+            if row.item_rate is not None:
+                item_rate = 0.5 * item_rate + 0.5 * row.item_rate
+            (db.session.query(QueueCursor)
+                .filter(and_(QueueCursor.subreddit_id == subreddit_id,
+                             QueueCursor.queue == name))
+                .update({'fullname': fullname,
+                         'created_utc': created_utc,
+                         'updated_time': now,
+                         'item_rate': item_rate},
+                        synchronize_session=False))
+        else:
+            cursor = QueueCursor()
+            cursor.subreddit_id = subreddit_id
+            cursor.queue = name
+            cursor.fullname = fullname
+            cursor.created_utc = created_utc
+            cursor.updated_time = now
+            db.session.add(cursor)
+
+
+def load_condition_snapshot(subreddits):
+    """Loads the conditions for all the subreddits and indexes them.
+
+    Returns a dict keyed by (subreddit name, queue name, subject, action),
+    where each value is a tuple of the compiled top-level conditions that
+    apply, already sorted so the easiest ones are checked first.
+
+    For subreddits with check_all_conditions set, the dict also has
+    (subreddit name, subject) keys holding a dict of attribute name to
+    MultiMatcher for all of that subject's top-level conditions.
+    """
+    snapshot = dict()
+    if not subreddits:
+        return snapshot
+
+    try:
+        condition_stats.load()
+    except Exception as e:
+        logging.error('  ERROR: couldn\'t load condition stats: %s', e)
+        db.session.rollback()
+
+    sr_conditions = dict((s.id, list()) for s in subreddits)
+    top_level = Condition.query.filter(
+                    and_(Condition.subreddit_id.in_(sr_conditions.keys()),
+                         Condition.parent_id == None)).all()
+    disabled = 0
+    for condition in top_level:
+        if is_disabled(condition):
+            disabled += 1
+            continue
+        sr_conditions[condition.subreddit_id].append(condition)
+    retain_matchers(top_level)
+
+    for subreddit in subreddits:
+        # sorting walks all the sub-conditions too, so this also makes sure
+        # the whole tree is loaded before any items are checked
+        conditions = compile_conditions(sr_conditions[subreddit.id])
+        sort_conditions(conditions)
+
+        if subreddit.check_all_conditions:
+            for subject in SUBJECTS:
+                matchers = build_multi_matchers(
+                            [c for c in conditions if c.subject == subject])
+                if matchers:
+                    snapshot[(subreddit.name.lower(), subject)] = matchers
+
+        for name in QUEUES:
+            queue_conditions = filter_conditions(name, subreddit, conditions)
+            for subject in SUBJECTS:
+                for action in ('remove', 'approve'):
+                    matches = tuple(c for c in queue_conditions
+                                    if c.subject == subject and
+                                    c.action == action)
+                    if matches:
+                        key = (subreddit.name.lower(), name, subject, action)
+                        snapshot[key] = matches
+
+    logging.info('Loaded %s conditions for %s subreddits',
+                 len(top_level) - disabled, len(subreddits))
+    if disabled:
+        logging.info('  Skipped %s disabled conditions', disabled)
+    return snapshot
+
+
+def sort_conditions(conditions):
+    """Sorts conditions, and all their sub-conditions, by condition_order().
+    """
+    conditions.sort(key=condition_order)
+    for condition in conditions:
+        # the order isn't stored anywhere, so this doesn't change anything
+        # in the database
+        sort_conditions(condition.additional_conditions)
+
+
+def condition_order(condition):
+    """Sort key putting the conditions likely to decide an item cheaply first.
+
+    Checking stops at the first matching condition (and sub-conditions stop
+    at the first one that doesn't match), so the expected cost is lowest
+    when conditions are checked in order of their cost divided by their
+    chance of matching. The cost is the mean time it takes to check, plus
+    request_cost seconds for each reddit request it makes (which also use
+    up the rate limit). Conditions without enough stats yet are given a cost
+    from condition_complexity() and even odds of matching.
+    """
+    request_cost = cfg_option('conditions', 'request_cost', 2.0)
+    stats = condition_stats.get(condition.id)
+    if stats is None or stats.evaluations < MIN_EVALUATIONS:
+        cost = 0.001 + condition_complexity(condition) * request_cost
+        probability = 0.5
+    else:
+        cost = ((stats.total_seconds + stats.requests * request_cost) /
+                stats.evaluations)
+        probability = (stats.matches + 1.0) / (stats.evaluations + 2.0)
+
+    # checking sub-conditions stops at the first one that doesn't match, so
+    # for them it's the chance of not matching that counts
+    if condition.parent_id is not None:
+        probability = 1.0 - probability
+    return cost / max(probability, 0.001)
 
 
-def filter_conditions(name, conditions):
+def is_disabled(condition):
+    """Returns True if a condition or any of its sub-conditions is disabled.
+
+    Checking a condition without one of its sub-conditions would match more
+    than intended, so the whole condition is skipped.
+    """
+    if condition.disabled or condition.id in strike_condition.disabled:
+        return True
+    return any(is_disabled(sub) for sub in condition.additional_conditions)
+
+
+def filter_conditions(name, subreddit, conditions):
     """Filters a list of conditions based on the queue's needs."""
     if name == 'spam':
         return conditions
@@ -249,7 +744,7 @@ def filter_conditions(name, conditions):
         return [c for c in conditions if c.subject == 'comment' and
                 c.is_shadowbanned != True]
     elif name == 'submission':
-        if conditions[0].subreddit.confirm_ham:
+        if subreddit.confirm_ham:
             return [c for c in conditions if c.is_shadowbanned != True]
         else:
             return [c for c in conditions if c.action == 'remove' and
@@ -259,35 +754,56 @@ def filter_conditions(name, conditions):
                 c.is_shadowbanned != True]
 
 
-def check_conditions(subreddit, item, conditions):
+def get_subject(item):
+    """Returns which condition subject applies to an item."""
+    if isinstance(item, reddit.objects.Submission):
+        return 'submission'
+    elif isinstance(item, reddit.objects.Comment):
+        return 'comment'
+    return None
+
+
+def check_conditions(subreddit, view, conditions, matchers=None):
     """Checks an item against a set of conditions.
 
+    view is an ItemView of the item. The conditions should already be
+    filtered down to the item's subject and sorted in the order they should
+    be checked. matchers is an optional dict of attribute name to
+    MultiMatcher for the subreddit and subject.
+
     Returns the first condition that matches, or a list of all conditions that
     match if check_all_conditions is set on the subreddit. Returns None if no
     conditions match.
     """
-    if isinstance(item, reddit.objects.Submission):
-        conditions = [c for c in conditions
-                          if c.subject == 'submission']
-        logging.debug('      Checking submission titled "%s"',
-                        item.title.encode('ascii', 'ignore'))
-    elif isinstance(item, reddit.objects.Comment):
-        conditions = [c for c in conditions
-                          if c.subject == 'comment']
-        logging.debug('      Checking comment by user %s',
-                        item.author.name)
+    item = view.item
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        if isinstance(item, reddit.objects.Submission):
+            logging.debug('      Checking submission titled "%s"',
+                            view.get_debug('title'))
+        elif isinstance(item, reddit.objects.Comment):
+            logging.debug('      Checking comment by user %s',
+                            item.author.name)
+
+    # every condition gets checked when check_all_conditions is set, so run
+    # all the regexes for each attribute through their combined matcher
+    item_matches = None
+    if subreddit.check_all_conditions and matchers:
+        item_matches = view.get_matches(matchers)
 
-    # sort the conditions so the easiest ones are checked first
-    conditions.sort(key=condition_complexity)
     matched = list()
 
     for condition in conditions:
+        condition_start = time()
         try:
-            match = check_condition(item, condition)
+            match = check_condition(view, condition, item_matches)
         except:
             match = False
+        metrics.observe('modbot_condition_seconds', time() - condition_start,
+                        condition=condition.id, subreddit=subreddit.name)
 
         if match:
+            metrics.inc('modbot_condition_matches',
+                        condition=condition.id, subreddit=subreddit.name)
             if subreddit.check_all_conditions:
                 matched.append(condition)
             else:
@@ -300,52 +816,73 @@ def check_conditions(subreddit, item, conditions):
     return None
 
 
-def check_condition(item, condition):
+def check_condition(view, condition, item_matches=None):
     """Checks an item against a single condition (and sub-conditions).
 
+    view is an ItemView of the item. If item_matches (an ItemMatches) covers
+    the condition, the result of its regex is taken from there instead of
+    being tested separately.
+
+    The regex is checked first, then the sub-conditions (in their sorted
+    order), and the user conditions last, since they usually need requests.
+    The time, requests and result are recorded in condition_stats.
+
     Returns True if it matches, or False if not
     """
     start_time = time()
-    if condition.attribute == 'user':
-        if item.author:
-            test_string = item.author.name
-    elif (condition.attribute == 'body' and
-            isinstance(item, reddit.objects.Submission)):
-        test_string = item.selftext
-    elif condition.attribute.startswith('media_'):
-        if item.media:
-            try:
-                if condition.attribute == 'media_user':
-                    test_string = item.media['oembed']['author_name']
-                elif condition.attribute == 'media_title':
-                    test_string = item.media['oembed']['description']
-                elif condition.attribute == 'media_description':
-                    test_string = item.media['oembed']['description']
-            except KeyError:
-                test_string = ''
-        else:
-            test_string = ''
-    elif condition.attribute == 'meme_name':
-        test_string = get_meme_name(item)
-    else:
-        test_string = getattr(item, condition.attribute)
-    if not test_string:
-        test_string = ''
+    start_requests = ModbotReddit.thread_requests()
+    satisfied = False
+    try:
+        satisfied = evaluate_condition(view, condition, item_matches)
+    finally:
+        # recorded however the check ended, so the stats include conditions
+        # that couldn't be evaluated or timed out
+        condition_stats.record(condition.id, time() - start_time,
+                               ModbotReddit.thread_requests() -
+                               start_requests,
+                               satisfied)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('        Result = %s in %s',
+                        satisfied, elapsed_since(start_time))
+    return satisfied
 
-    if condition.inverse:
-        logging.debug('        Check #%s: "%s" NOT match ^%s$',
-                        condition.id,
-                        test_string.encode('ascii', 'ignore'),
-                        condition.value.encode('ascii', 'ignore').lower())
-    else:
-        logging.debug('        Check #%s: "%s" match ^%s$',
+
+def evaluate_condition(view, condition, item_matches=None):
+    """Does the checking for check_condition(), which records it."""
+    test_string = view.get_lower(condition.attribute)
+    if test_string is None:
+        # no author to check (deleted), so this can't be evaluated
+        return False
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug('        Check #%s: "%s" %smatch ^%s$',
                         condition.id,
-                        test_string.encode('ascii', 'ignore'),
+                        view.get_debug(condition.attribute),
+                        'NOT ' if condition.inverse else '',
                         condition.value.encode('ascii', 'ignore').lower())
 
-    if re.search('^'+condition.value.lower()+'$',
-            test_string.lower(),
-            re.DOTALL|re.UNICODE):
+    # checked before item_matches, which could still have a condition that
+    # was disabled since the snapshot was loaded
+    if condition.id in strike_condition.disabled:
+        return False
+    elif item_matches is not None and item_matches.covers(condition):
+        regex_match = item_matches.matched(condition)
+    else:
+        matcher = get_matcher(condition)
+        search_start = time()
+        try:
+            regex_match = matcher.search(test_string)
+        except MatchTimeout:
+            strike_condition(condition)
+            return False
+        # guarded searches can queue up behind each other for the watchdog,
+        # so they're only struck on MatchTimeout (which uses the time of the
+        # search itself), never on the time taken here
+        if (not isinstance(matcher, GuardedMatcher) and
+                time() - search_start > matching.time_budget):
+            strike_condition(condition)
+
+    if regex_match:
         satisfied = True
     else:
         satisfied = False
@@ -354,28 +891,141 @@ def check_condition(item, condition):
     if condition.inverse:
         satisfied = not satisfied
 
-    # check user conditions if necessary
-    if satisfied:
-        satisfied = check_user_conditions(item, condition)
-        logging.debug('          User condition result = %s', satisfied)
-
     # make sure all sub-conditions are satisfied as well
     if satisfied:
         if condition.additional_conditions:
             logging.debug('        Checking sub-conditions:')
         for sub_condition in condition.additional_conditions:
-            match = check_condition(item, sub_condition)
+            match = check_condition(view, sub_condition)
             if not match:
                 satisfied = False
                 break
         if condition.additional_conditions:
             logging.debug('        Sub-condition result = %s', satisfied)
 
-    logging.debug('        Result = %s in %s',
-                    satisfied, elapsed_since(start_time))
+    # check user conditions if necessary
+    if satisfied:
+        satisfied = check_user_conditions(view.item, condition)
+        logging.debug('          User condition result = %s', satisfied)
+
     return satisfied
 
 
+def strike_condition(condition):
+    """Counts a condition's regex going over the time budget.
+
+    Once a condition has done that max_strikes times (over any number of
+    runs), it's disabled in the database, and not checked for the rest of
+    this run either. Strikes are only logged if strike_condition.persist
+    is False (e.g. while backtesting).
+    """
+    logging.warning('  Condition #%s took over %ss to check',
+                    condition.id, matching.time_budget)
+    metrics.inc('modbot_condition_timeouts', condition=condition.id)
+    if condition.id is None or not strike_condition.persist:
+        return
+
+    table = Condition.__table__
+    db.engine.execute(table.update()
+        .where(table.c.id == condition.id)
+        .values(timeout_strikes=func.coalesce(table.c.timeout_strikes, 0)+1))
+    strikes = db.engine.execute(
+        select([table.c.timeout_strikes]).where(table.c.id == condition.id)
+        ).scalar()
+
+    if strikes >= cfg_option('conditions', 'max_strikes', 3):
+        db.engine.execute(table.update()
+            .where(table.c.id == condition.id)
+            .values(disabled=True))
+        strike_condition.disabled.add(condition.id)
+        logging.error('  ERROR: disabled condition #%s after %s checks went '
+                      'over the time budget, its regex "%s" needs fixing',
+                      condition.id, strikes,
+                      condition.value.encode('ascii', 'ignore'))
+strike_condition.disabled = set()
+strike_condition.persist = True
+
+
+class ItemView(object):
+
+    """Wraps an item so each attribute is only extracted once.
+
+    All the conditions (and sub-conditions) checked against an item share one
+    view, so the attribute lookups, meme page loads, lowercasing and encoding
+    for debug logs only happen the first time an attribute is needed.
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.strings = dict()
+        self.lowered = dict()
+        self.matches = dict()
+
+    def get(self, attribute):
+        """Returns the attribute's test string (None if there's no author)."""
+        try:
+            return self.strings[attribute]
+        except KeyError:
+            test_string = get_test_string(self.item, attribute)
+            self.strings[attribute] = test_string
+            return test_string
+
+    def get_lower(self, attribute):
+        """Returns the attribute's test string, lowercased."""
+        try:
+            return self.lowered[attribute]
+        except KeyError:
+            test_string = self.get(attribute)
+            if test_string is not None:
+                test_string = test_string.lower()
+            self.lowered[attribute] = test_string
+            return test_string
+
+    def get_debug(self, attribute):
+        """Returns the attribute's test string, encoded for logging."""
+        return (self.get(attribute) or '').encode('ascii', 'ignore')
+
+    def get_matches(self, matchers):
+        """Returns the ItemMatches of this item for a set of MultiMatchers."""
+        key = id(matchers)
+        if key not in self.matches:
+            self.matches[key] = ItemMatches(matchers, self.get_lower)
+        return self.matches[key]
+
+
+def get_test_string(item, attribute):
+    """Returns the string from an item that a condition attribute checks.
+
+    Returns None if the attribute is the author but the item doesn't have one.
+    """
+    test_string = None
+    if attribute == 'user':
+        if not item.author:
+            return None
+        test_string = item.author.name
+    elif attribute == 'body' and isinstance(item, reddit.objects.Submission):
+        test_string = item.selftext
+    elif attribute.startswith('media_'):
+        if item.media:
+            try:
+                if attribute == 'media_user':
+                    test_string = item.media['oembed']['author_name']
+                elif attribute == 'media_title':
+                    test_string = item.media['oembed']['title']
+                elif attribute == 'media_description':
+                    test_string = item.media['oembed']['description']
+            except KeyError:
+                pass
+    elif attribute == 'meme_name':
+        test_string = get_meme_name(item)
+    else:
+        test_string = getattr(item, attribute)
+
+    if not test_string:
+        test_string = ''
+    return test_string
+
+
 def check_user_conditions(item, condition):
     """Checks an item's author against the age/karma/has-gold requirements."""
     # if no user conditions are set, no need to check at all
@@ -401,14 +1051,11 @@ def check_user_conditions(item, condition):
 
     # shadowbanned check
     if condition.is_shadowbanned is not None:
-        user = item.reddit_session.get_redditor(item.author, fetch=False)
-        try: # try to get user overview
-            list(user.get_overview(limit=1))
-        except: # if that failed, they're probably shadowbanned
+        if check_shadowbanned(item):
             return fail_result
 
     # get user info
-    user = item.reddit_session.get_redditor(item.author)
+    user = get_redditor_info(item)
 
     # reddit gold check
     if condition.is_gold is not None:
@@ -438,69 +1085,252 @@ def check_user_conditions(item, condition):
     return not fail_result
 
 
-def in_modqueue(item):
-    """Checks if an item is in the modqueue (hasn't been acted on yet)."""
-    global r
-    if not in_modqueue.modqueue:
-        mod_subreddit = r.get_subreddit('mod')
-        in_modqueue.modqueue = mod_subreddit.get_modqueue()
-        in_modqueue.cache = list()
+def get_redditor_info(item):
+    """Returns a RedditorInfo for the item's author.
 
-    for i in in_modqueue.cache:
-        if i.created_utc < item.created_utc:
-            return False
-        if i.id == item.id:
+    Checks the in-process cache first, then the redditor_cache table if
+    persist_redditors is enabled, and only fetches the profile from reddit if
+    neither has an entry that's still fresh.
+    """
+    global redditor_cache
+    if redditor_cache is None:
+        setup_caches()
+
+    name = item.author.name.lower()
+    info = redditor_cache.get(name)
+    if info is not None:
+        return info
+
+    persist = cfg_option('cache', 'persist_redditors', False)
+    if persist:
+        entry = RedditorCache.query.filter(RedditorCache.name == name).first()
+        now = datetime.utcnow()
+        if entry:
+            expires = (entry.fetched_time +
+                       timedelta(seconds=redditor_cache.ttl))
+            if expires > now:
+                info = RedditorInfo(entry.link_karma,
+                                    entry.comment_karma,
+                                    timegm(entry.created_utc.utctimetuple()),
+                                    entry.is_gold)
+                # only for as long as the entry has left, not a whole new ttl
+                redditor_cache.set(name, info, total_seconds(expires - now))
+                return info
+
+    with ratelimit.priority(ratelimit.PRIORITY_LOOKUP):
+        user = item.reddit_session.get_redditor(item.author)
+    info = RedditorInfo(user.link_karma,
+                        user.comment_karma,
+                        user.created_utc,
+                        user.is_gold)
+    redditor_cache.set(name, info)
+
+    if persist:
+        if not entry:
+            entry = RedditorCache()
+            entry.name = name
+        entry.link_karma = info.link_karma
+        entry.comment_karma = info.comment_karma
+        entry.created_utc = datetime.utcfromtimestamp(info.created_utc)
+        entry.is_gold = info.is_gold
+        entry.fetched_time = datetime.utcnow()
+        save_cache_entry(entry)
+
+    return info
+
+
+def check_shadowbanned(item):
+    """Returns True if the item's author appears to be shadowbanned.
+
+    Verdicts are cached in-process and in the shadowban_cache table, with
+    separate TTLs for banned and not-banned verdicts. Only a 404 from the
+    user's overview counts as a (cacheable) shadowban, any other error is
+    treated as banned for this check but not cached.
+    """
+    global shadowban_cache
+    if shadowban_cache is None:
+        setup_caches()
+
+    name = item.author.name.lower()
+    verdict = shadowban_cache.get(name)
+    if verdict is not None:
+        check_shadowbanned.hits += 1
+        return verdict
+
+    now = datetime.utcnow()
+    entry = ShadowbanCache.query.filter(ShadowbanCache.name == name).first()
+    if entry:
+        expires = (entry.checked_time +
+                   timedelta(seconds=shadowban_ttl(entry.is_shadowbanned)))
+        if expires > now:
+            check_shadowbanned.hits += 1
+            shadowban_cache.set(name, entry.is_shadowbanned,
+                                total_seconds(expires - now))
+            return entry.is_shadowbanned
+
+    check_shadowbanned.misses += 1
+    user = item.reddit_session.get_redditor(item.author, fetch=False)
+    try: # try to get user overview
+        with ratelimit.priority(ratelimit.PRIORITY_LOOKUP):
+            list(user.get_overview(limit=1))
+        verdict = False
+    except urllib2.HTTPError as e:
+        # if that 404s, they're shadowbanned
+        if e.code != 404:
             return True
+        verdict = True
+    except:
+        return True
 
-    for i in in_modqueue.modqueue:
-        in_modqueue.cache.append(i)
-        if i.created_utc < item.created_utc:
-            return False
-        if i.id == item.id:
-            return True
+    shadowban_cache.set(name, verdict, shadowban_ttl(verdict))
+    if not entry:
+        entry = ShadowbanCache()
+        entry.name = name
+    entry.is_shadowbanned = verdict
+    entry.checked_time = now
+    save_cache_entry(entry)
+
+    return verdict
+check_shadowbanned.hits = 0
+check_shadowbanned.misses = 0
+
+
+def shadowban_ttl(is_shadowbanned):
+    """Returns how many seconds a shadowban verdict should be cached for."""
+    if is_shadowbanned:
+        return cfg_option('cache', 'shadowbanned_ttl', 86400)
+    return cfg_option('cache', 'not_shadowbanned_ttl', 21600)
+
+
+def save_cache_entry(entry):
+    """Saves a cache table entry in a savepoint.
+
+    If another worker inserted the same entry first, this one is just
+    dropped instead of failing the whole transaction.
+    """
+    try:
+        db.session.begin_nested()
+        db.session.add(entry)
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+
+def setup_caches():
+    """Creates the in-process caches using the sizes/TTLs from the config.
+
+    Also sets the time budget for condition regexes.
+    """
+    global redditor_cache, shadowban_cache, meme_cache, meme_pool
+    matching.set_time_budget(cfg_option('conditions', 'time_budget', 1.0))
+    redditor_cache = TTLCache(cfg_option('cache', 'redditor_ttl', 3600),
+                              cfg_option('cache', 'redditor_max_size', 10000))
+    shadowban_cache = TTLCache(shadowban_ttl(False),
+                               cfg_option('cache', 'redditor_max_size', 10000))
+    meme_cache = TTLCache(meme_ttl(True),
+                          cfg_option('cache', 'meme_max_size', 5000))
+    meme_pool = ConnectionPool(cfg_file.get('reddit', 'user_agent'),
+                               timeout=cfg_option('cache', 'meme_timeout', 10))
+
+
+class ModqueueIndex(object):
+
+    """Checks if items are in the modqueue (haven't been acted on yet).
+
+    The modqueue listing is newest-first, so it's only read as far back as
+    the oldest item that's been asked about, and everything read is kept in
+    a dict by id, making each check O(1) amortized. The index is bounded by
+    the listing limit.
+    """
 
-    return False
-in_modqueue.modqueue = None
+    def __init__(self, get_listing):
+        self.get_listing = get_listing
+        self.reset()
 
+    def reset(self):
+        """Forgets everything, the listing restarts on the next check."""
+        self.listing = None
+        self.items = dict()
+        self.cursor = None
+        self.exhausted = False
 
-def respond_to_modmail(modmail, start_time):
-    """Responds to modmail if any submitters sent one before approval."""
-    cache = list()
-    approvals = ActionLog.query.filter(
-                    and_(ActionLog.action == 'approve',
-                         ActionLog.action_time >= start_time)).all()
+    def __contains__(self, item):
+        if self.listing is None:
+            self.listing = iter(self.get_listing())
 
-    for item in approvals:
-        found = None
-        done = False
+        if item.id in self.items:
+            return True
 
-        for i in cache:
-            if datetime.utcfromtimestamp(i.created_utc) < item.created_utc:
-                done = True
+        # read until we're past the item's age, it can't be any further down
+        while (not self.exhausted and
+                (self.cursor is None or self.cursor >= item.created_utc)):
+            try:
+                i = next(self.listing)
+            except StopIteration:
+                self.exhausted = True
                 break
-            if (i.dest.lower() == '#'+item.subreddit.name.lower() and
-                    i.author.name == item.user and
-                    not i.replies):
-                found = i
+            self.items[i.id] = i.created_utc
+            self.cursor = i.created_utc
+            if i.id == item.id:
+                return True
+
+        return False
+
+
+def respond_to_modmail(modmail, start_time, subreddit_ids=None):
+    """Responds to modmail if any submitters sent one before approval.
+
+    The approvals are gone through newest-first while reading the (also
+    newest-first) modmail alongside them, indexing unreplied messages by
+    (destination, author). Each stream is only read once.
+
+    If subreddit_ids is set, only approvals in those subreddits are
+    responded to.
+    """
+    approvals = (db.session.query(ActionLog.user,
+                                  ActionLog.created_utc,
+                                  Subreddit.name)
+                    .join(ActionLog.subreddit)
+                    .filter(and_(ActionLog.action == 'approve',
+                                 ActionLog.action_time >= start_time)))
+    if subreddit_ids is not None:
+        approvals = approvals.filter(
+            ActionLog.subreddit_id.in_(subreddit_ids))
+    approvals = approvals.order_by(ActionLog.created_utc.desc()).all()
+
+    modmail = iter(modmail)
+    index = dict()
+    exhausted = False
+    oldest = None
+
+    for user, created_utc, sr_name in approvals:
+        # read until the messages are older than the approved item, anything
+        # sent before it was submitted can't be about it
+        while not exhausted and (oldest is None or oldest >= created_utc):
+            try:
+                message = next(modmail)
+            except StopIteration:
+                exhausted = True
                 break
+            oldest = datetime.utcfromtimestamp(message.created_utc)
+            if message.author and not message.replies:
+                key = (message.dest.lower(), message.author.name)
+                index.setdefault(key, message)
+
+        key = ('#'+sr_name.lower(), user)
+        found = index.get(key)
+        if (not found or
+                datetime.utcfromtimestamp(found.created_utc) < created_utc):
+            continue
 
-        if not found and not done:
-            for i in modmail:
-                cache.append(i)
-                if datetime.utcfromtimestamp(i.created_utc) < item.created_utc:
-                    break
-                if (i.dest.lower() == '#'+item.subreddit.name.lower() and
-                        i.author.name == item.user and
-                        not i.replies):
-                    found = i
-                    break
-
-        if found:
-            found.reply('Your submission has been approved automatically by '+
-                cfg_file.get('reddit', 'username')+'. For future submissions '
-                'please wait at least 5 minutes before messaging the mods, '
-                'this post would have been approved automatically even '
-                'without you sending this message.')
+        # only reply once, even if they had more than one item approved
+        del index[key]
+        with ratelimit.priority(ratelimit.PRIORITY_APPROVAL):
+            found.reply('Your submission has been approved automatically '
+                'by '+cfg_file.get('reddit', 'username')+'. For future '
+                'submissions please wait at least 5 minutes before messaging '
+                'the mods, this post would have been approved automatically '
+                'even without you sending this message.')
 
 
 def get_meme_name(item):
@@ -522,19 +1352,71 @@ def get_meme_name(item):
     else:
         return None
 
-    # load the page and extract the meme name
+    return lookup_meme_name(item.domain, url)
+
+
+def lookup_meme_name(domain, url):
+    """Returns the meme name from the page at url, using the caches.
+
+    Failures are cached too (for meme_failure_ttl), so a broken or slow page
+    isn't retried for every condition and every run.
+    """
+    global meme_cache
+    if meme_cache is None:
+        setup_caches()
+
+    # failures are cached as an empty string
+    meme_name = meme_cache.get(url)
+    if meme_name is not None:
+        return meme_name or None
+
+    now = datetime.utcnow()
+    entry = MemeCache.query.filter(MemeCache.url == url).first()
+    if entry:
+        expires = entry.fetched_time + timedelta(
+                        seconds=meme_ttl(entry.meme_name is not None))
+        if expires > now:
+            meme_cache.set(url, entry.meme_name or '',
+                           total_seconds(expires - now))
+            return entry.meme_name
+
+    meme_name = fetch_meme_name(domain, url)
+    if meme_name:
+        meme_name = meme_name[:255]
+    meme_cache.set(url, meme_name or '', meme_ttl(meme_name is not None))
+
+    # too long to fit in the table, only keep it in-process
+    if len(url) > 255:
+        return meme_name
+
+    if not entry:
+        entry = MemeCache()
+        entry.url = url
+    entry.meme_name = meme_name
+    entry.fetched_time = now
+    save_cache_entry(entry)
+
+    return meme_name
+
+
+def fetch_meme_name(domain, url):
+    """Loads the page at url and extracts the meme name from it."""
+    # only imported when a meme page actually needs parsing, most runs never
+    # get this far
+    from BeautifulSoup import BeautifulSoup
+
     try:
-        page = urllib2.urlopen(url)
+        page = meme_pool.fetch(url)
         soup = BeautifulSoup(page)
 
-        if (item.domain in ['quickmeme.com', 'qkme.me'] or
-                item.domain.endswith('.qkme.me')):
+        if (domain in ['quickmeme.com', 'qkme.me'] or
+                domain.endswith('.qkme.me')):
             return soup.findAll(id='meme_name')[0].text
-        elif item.domain.endswith('memegenerator.net'):
+        elif domain.endswith('memegenerator.net'):
             result = soup.findAll(attrs={'class': 'rank'})[0]
             matches = re.search('#\\d+ (.+)$', result.text)
             return matches.group(1)
-        elif item.domain == 'troll.me':
+        elif domain == 'troll.me':
             matches = re.search('^.+?\| (.+?) \|.+?$', soup.title.text)
             return matches.group(1)
     except:
@@ -542,6 +1424,25 @@ def get_meme_name(item):
     return None
 
 
+def prune_meme_cache():
+    """Deletes meme_cache entries that have expired, to keep it bounded."""
+    cutoff = datetime.utcnow() - timedelta(seconds=meme_ttl(True))
+    MemeCache.query.filter(MemeCache.fetched_time < cutoff).delete()
+    db.session.commit()
+
+
+def meme_ttl(found):
+    """Returns how many seconds a meme page result should be cached for."""
+    if found:
+        return cfg_option('cache', 'meme_ttl', 604800)
+    return cfg_option('cache', 'meme_failure_ttl', 3600)
+
+
+def total_seconds(delta):
+    """Returns the number of seconds in a timedelta."""
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+
 def elapsed_since(start_time):
     """Returns a timedelta for how much time has passed since start_time."""
     elapsed = time() - start_time
@@ -580,67 +1481,637 @@ def condition_complexity(condition):
     return complexity
 
 
-def main():
-    logging.config.fileConfig(path_to_cfg)
-    start_utc = datetime.utcnow()
-    start_time = time()
+class ModbotReddit(reddit.Reddit):
+
+    """The bot's reddit session, counting its requests in the metrics.
+
+    Requests are counted per queue, using the "queue" label set for the
+    thread making them, and per thread (see thread_requests()). If scheduler
+    (a RequestScheduler) is set, every request waits for its turn there
+    first.
+    """
+
+    scheduler = None
+    local = threading.local()
+
+    @classmethod
+    def thread_requests(cls):
+        """Returns how many requests the current thread has made."""
+        return getattr(cls.local, 'requests', 0)
+
+    def _request(self, *args, **kwargs):
+        ModbotReddit.local.requests = ModbotReddit.thread_requests() + 1
+        if self.scheduler:
+            level = ratelimit.current_priority()
+            waited = self.scheduler.acquire(level)
+            metrics.observe('modbot_ratelimit_wait_seconds', waited,
+                            priority=level)
+        metrics.inc('modbot_reddit_requests',
+                    queue=metrics.get_label('queue', 'other'))
+        return reddit.Reddit._request(self, *args, **kwargs)
+
+
+def login():
+    """Creates the global reddit session and logs in."""
+    global r
+    r = ModbotReddit(user_agent=cfg_file.get('reddit', 'user_agent'))
+    r.scheduler = ratelimit.RequestScheduler(
+        cfg_option('ratelimit', 'requests_per_minute', 30) / 60.0,
+        cfg_option('ratelimit', 'burst', 5))
+    logging.info('Logging in as %s', cfg_file.get('reddit', 'username'))
+    r.login(cfg_file.get('reddit', 'username'),
+        cfg_file.get('reddit', 'password'))
+
+
+def load_subreddits():
+    """Loads the enabled subreddits and a snapshot of their conditions.
+
+    When running sharded, this also renews this worker's leases, and only the
+    subreddits it holds leases for are loaded.
+
+    Returns a tuple of (subreddits, dict of lowercased name to subreddit,
+    condition snapshot).
+    """
+    enabled = Subreddit.query.filter(Subreddit.enabled == True)
+    if lease_manager:
+        # claimed before loading the rows, since claiming commits, which
+        # would expire them and reload each one on its next use
+        enabled_ids = [s.id for s in
+                       db.session.query(Subreddit.id)
+                           .filter(Subreddit.enabled == True)]
+        owned = lease_manager.claim(enabled_ids)
+        subreddits = list()
+        if owned:
+            subreddits = enabled.filter(Subreddit.id.in_(owned)).all()
+        logging.info('Holding leases for %s subreddits', len(subreddits))
+    else:
+        subreddits = enabled.all()
+    sr_dict = dict()
+    for subreddit in subreddits:
+        sr_dict[subreddit.name.lower()] = subreddit
+    snapshot = load_condition_snapshot(subreddits)
+
+    # detach everything that was loaded, so later commits don't expire it and
+    # worker threads never trigger lazy loads through this thread's session
+    db.session.expunge_all()
+    return (subreddits, sr_dict, snapshot)
+
+
+def listing_name(subreddits):
+    """Returns the subreddit the moderation listings are read from.
+
+    That's /r/mod normally, or a multireddit of this worker's subreddits
+    when running sharded.
+    """
+    if not lease_manager:
+        return 'mod'
+    return '+'.join(sorted(s.name for s in subreddits))
+
+
+def listed_subreddits(name, subreddits):
+    """Returns the subreddits whose items show up in a queue's listing."""
+    if name == 'comment':
+        return [s for s in subreddits if not s.reported_comments_only]
+    return subreddits
+
+
+def get_queue_listing(name, subreddits, limit=1000):
+    """Returns the listing generator for a queue, newest items first.
+
+    Returns None if there's nothing to fetch (no subreddits need their
+    comments checked, or this worker has no subreddits).
+    """
+    global r
+    subreddits = listed_subreddits(name, subreddits)
+    if not subreddits:
+        return None
+
+    if name == 'comment':
+        comment_multi_sr = r.get_subreddit(
+            '+'.join([s.name for s in subreddits]))
+        return comment_multi_sr.get_comments(limit=limit)
+
+    mod_subreddit = r.get_subreddit(listing_name(subreddits))
+    if name == 'report':
+        return mod_subreddit.get_reports(limit=limit)
+    elif name == 'spam':
+        return mod_subreddit.get_spam(limit=limit)
+    elif name == 'modqueue':
+        return mod_subreddit.get_modqueue(limit=limit)
+    elif name == 'submission':
+        return mod_subreddit.get_new_by_date(limit=limit)
+
+
+def get_new_items(name, subreddits, cursors):
+    """Returns the new items in the submission or comment listing.
+
+    The listing is read forwards from the newest cursor with before=, so
+    checking it only takes as many requests as there are pages of new items
+    (up to MAX_NEW_PAGES). The items are returned newest first, like a normal
+    listing.
+
+    If the cursor's item has dropped out of the listing (e.g. it's been
+    removed), reddit returns nothing at all for it, so the newest item is
+    loaded to tell that apart from there being nothing new. Returns None if
+    there's no usable cursor, and the listing needs to be read newest-first
+    from the start instead.
+    """
+    global r
+    subreddits = listed_subreddits(name, subreddits)
+    fullname, created_utc, _ = max((cursors[s.id] for s in subreddits),
+                                   key=lambda cursor: cursor.created_utc)
+    if not fullname:
+        return None
 
+    if name == 'comment':
+        url = ('http://www.reddit.com/r/%s/comments/'
+               % '+'.join([s.name for s in subreddits]))
+        url_data = dict()
+    else:
+        url = 'http://www.reddit.com/r/%s/new/' % listing_name(subreddits)
+        url_data = {'sort': 'new'}
+
+    pages = list()
+    before = fullname
+    for _ in range(MAX_NEW_PAGES):
+        url_data.update({'before': before, 'limit': 100})
+        data = r.request_json(url, url_data=url_data)['data']
+        if not data['children']:
+            break
+        pages.append(data['children'])
+        before = data['before']
+        if not before:
+            break
+
+    if not pages:
+        newest = list(get_queue_listing(name, subreddits, limit=1))
+        if (not newest or
+                datetime.utcfromtimestamp(newest[0].created_utc) <=
+                created_utc):
+            return []
+        logging.info('  %s is gone from the %s listing, reading it from the '
+                     'start', fullname, name)
+        return None
+
+    # each page is newest-first, but the pages go from oldest to newest
+    pages.reverse()
+    return [item for page in pages for item in page]
+
+
+def get_comment_items(subreddits, cursors):
+    """Yields the new comments from all the subreddits, newest first.
+
+    The subreddits are split into several multireddits (see
+    group_subreddits()), which are fetched at the same time and merged back
+    together by creation time. Nothing is fetched until the first comment is
+    asked for.
+    """
+    groups = group_subreddits(subreddits, cursors,
+        cfg_option('comments', 'max_multireddit_length', 2000),
+        cfg_option('comments', 'max_group_rate', 6000.0))
+    if len(groups) > 1:
+        logging.info('  Fetching comments in %s multireddits', len(groups))
+
+    def fetch(group):
+        metrics.set_label('queue', 'comment')
+        return fetch_comment_group(group, cursors)
+
+    if len(groups) == 1:
+        listings = [fetch(groups[0])]
+    else:
+        pool = ThreadPool(min(len(groups),
+                              cfg_option('comments', 'fetch_workers', 4)))
+        try:
+            listings = pool.map(fetch, groups)
+        finally:
+            pool.close()
+            pool.join()
+
+    for item in merge_newest_first(listings):
+        yield item
+
+
+def fetch_comment_group(subreddits, cursors):
+    """Returns a list of the new comments in one multireddit."""
+    items = get_new_items('comment', subreddits, cursors)
+    if items is None:
+        stop_time = min(cursors[s.id].created_utc for s in subreddits)
+        items = takewhile(lambda item: datetime.utcfromtimestamp(
+                              item.created_utc) > stop_time,
+                          get_queue_listing('comment', subreddits))
+    return list(items)
+
+
+def group_subreddits(subreddits, cursors, max_name_length, max_group_rate):
+    """Splits subreddits into groups for the comment multireddits.
+
+    Each group's multireddit name is kept to max_name_length characters, and
+    its subreddits' combined comments per hour to max_group_rate, so that
+    busy subreddits can't push the others' comments out of the 1000-item
+    listing before they're read. Subreddits go in busiest first, each into
+    the least busy group it fits in. Subreddits without a known rate are
+    counted as average ones.
+    """
+    known = [c.item_rate for c in cursors.values() if c.item_rate is not None]
+    default_rate = sum(known) / len(known) if known else 0.0
+
+    def item_rate(subreddit):
+        rate = cursors[subreddit.id].item_rate
+        if rate is None:
+            return default_rate
+        return rate
+
+    # each group is [total rate, multireddit name length, subreddits]
+    groups = list()
+    for subreddit in sorted(subreddits, key=item_rate, reverse=True):
+        rate = item_rate(subreddit)
+        length = len(subreddit.name) + 1
+        fits = [g for g in groups
+                if g[0] + rate <= max_group_rate and
+                   g[1] + length <= max_name_length]
+        if fits:
+            group = min(fits, key=lambda g: g[0])
+        else:
+            group = [0.0, -1, list()]
+            groups.append(group)
+        group[0] += rate
+        group[1] += length
+        group[2].append(subreddit)
+
+    return [g[2] for g in groups]
+
+
+def merge_newest_first(listings):
+    """Merges newest-first listings into one, by created_utc."""
+    def decorate(index, listing):
+        # the index and position break ties, so items are never compared
+        for position, item in enumerate(listing):
+            yield (-item.created_utc, index, position), item
+
+    for _, item in heapq.merge(*[decorate(i, listing)
+                                 for i, listing in enumerate(listings)]):
+        yield item
+
+
+def check_queue(name, subreddits, sr_dict, snapshot):
+    """Fetches a queue's new items and checks them.
+
+    The spam, submission and comment queues are read up to each subreddit's
+    cursor, and the submission and comment listings are read forwards from
+    the newest cursor when possible (comments in several multireddits, see
+    get_comment_items()). Reports are always read back to
+    REPORT_BACKLOG_LIMIT.
+
+    Returns the number of new items, for QueueSchedule. For reports, that's
+    the items that are newly reported or have had more reports since the
+    last check, not everything still in the report queue.
+    """
+    metrics.set_label('queue', name)
+    listed = listed_subreddits(name, subreddits)
+    if not listed:
+        return 0
+
+    modqueue = None
+    cursors = None
+    if name == 'report':
+        stop_time = datetime.utcnow() - REPORT_BACKLOG_LIMIT
+    else:
+        cursors = load_cursors(name, listed)
+        # nothing in the listing can be new past the oldest cursor
+        stop_time = min(c.created_utc for c in cursors.values())
+
+    if name == 'spam':
+        # only index the modqueue as it is for this check
+        modqueue = ModqueueIndex(
+                    lambda: get_queue_listing('modqueue', subreddits))
+
+    def get_items():
+        # a generator, so the requests happen inside check_items() and any
+        # errors from them are handled there
+        items = None
+        if name == 'submission':
+            items = get_new_items(name, listed, cursors)
+        elif name == 'comment':
+            items = get_comment_items(listed, cursors)
+        if items is None:
+            items = get_queue_listing(name, listed)
+        for item in items:
+            if name == 'report':
+                num_reports = getattr(item, 'num_reports', None)
+                if check_queue.reports.get(item.name) != num_reports:
+                    changed[0] += 1
+                reports[item.name] = num_reports
+            yield item
+
+    changed = [0]
+    reports = dict()
+    count = check_items(name, get_items(), sr_dict, stop_time, snapshot,
+                        modqueue, cursors)
+    if name != 'report':
+        return count
+    # only what's still in the window is kept
+    check_queue.reports = reports
+    return changed[0]
+# fullname to number of reports, for the items in the last report check
+check_queue.reports = dict()
+
+
+def check_queues(names, subreddits, sr_dict, snapshot, concurrent=False):
+    """Checks several queues, optionally all at the same time.
+
+    With concurrent set, each queue is fetched and checked in its own thread
+    (with its own database session), so the total time is about that of the
+    slowest queue instead of the sum of them all.
+
+    Returns a dict of queue name to the number of items checked.
+    """
+    def worker(name):
+        # an error in one queue shouldn't keep the others from being checked
+        try:
+            return check_queue(name, subreddits, sr_dict, snapshot)
+        except Exception as e:
+            logging.error('  ERROR: %s', e)
+            db.session.rollback()
+            return 0
+        finally:
+            if concurrent:
+                db.session.remove()
+
+    if not concurrent or len(names) < 2:
+        return dict((name, worker(name)) for name in names)
+
+    pool = ThreadPool(len(names))
+    try:
+        counts = pool.map(worker, names)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(names, counts))
+
+
+def run_tasks(sr_dict, since):
+    """Does the non-queue tasks: modmail responses and the reports page.
+
+    since is the utc datetime that approvals are responded to from.
+    """
     global r
+    metrics.set_label('queue', 'tasks')
+
+    # approvals need to be logged before they can be matched with modmail
     try:
-        r = reddit.Reddit(user_agent=cfg_file.get('reddit', 'user_agent'))
-        logging.info('Logging in as %s', cfg_file.get('reddit', 'username'))
-        r.login(cfg_file.get('reddit', 'username'),
-            cfg_file.get('reddit', 'password'))
-
-        subreddits = Subreddit.query.filter(Subreddit.enabled == True).all()
-        sr_dict = dict()
-        for subreddit in subreddits:
-            sr_dict[subreddit.name.lower()] = subreddit
-        mod_subreddit = r.get_subreddit('mod')
+        if action_executor:
+            action_executor.wait()
     except Exception as e:
-        logging.error('  ERROR: %s', e)
+        logging.error('  ERROR: couldn\'t log actions: %s', e)
 
-    # check reports
-    items = mod_subreddit.get_reports(limit=1000)
-    stop_time = datetime.utcnow() - REPORT_BACKLOG_LIMIT
-    check_items('report', items, sr_dict, stop_time)
-
-    # check spam
-    items = mod_subreddit.get_spam(limit=1000)
-    stop_time = (db.session.query(func.max(Subreddit.last_spam))
-                 .filter(Subreddit.enabled == True).one()[0])
-    check_items('spam', items, sr_dict, stop_time)
-
-    # check new submissions
-    items = mod_subreddit.get_new_by_date(limit=1000)
-    stop_time = (db.session.query(func.max(Subreddit.last_submission))
-                 .filter(Subreddit.enabled == True).one()[0])
-    check_items('submission', items, sr_dict, stop_time)
-
-    # check new comments
-    comment_multi = '+'.join([s.name for s in subreddits
-                              if not s.reported_comments_only])
-    if comment_multi:
-        comment_multi_sr = r.get_subreddit(comment_multi)
-        items = comment_multi_sr.get_comments(limit=1000)
-        stop_time = (db.session.query(func.max(Subreddit.last_comment))
-                     .filter(Subreddit.enabled == True).one()[0])
-        check_items('comment', items, sr_dict, stop_time)
+    try:
+        condition_stats.flush()
+    except Exception as e:
+        logging.error('  ERROR: couldn\'t save condition stats: %s', e)
+        # not rollback(), which can fail the same way if the connection is
+        # what broke, and would keep the other tasks from running
+        db.session.remove()
 
     # respond to modmail
+    subreddit_ids = None
+    if lease_manager:
+        subreddit_ids = [s.id for s in sr_dict.values()]
     try:
-        respond_to_modmail(r.user.get_modmail(), start_utc)
+        respond_to_modmail(r.user.get_modmail(), since, subreddit_ids)
     except Exception as e:
         logging.error('  ERROR: %s', e)
 
     # check reports html
     try:
-        check_reports_html(sr_dict)
+        if sr_dict:
+            check_reports_html(sr_dict)
+    except Exception as e:
+        logging.error('  ERROR: %s', e)
+
+    # make sure the alerts are logged before the page is checked again
+    try:
+        if action_executor:
+            action_executor.wait()
+    except Exception as e:
+        logging.error('  ERROR: couldn\'t log actions: %s', e)
+
+    try:
+        prune_meme_cache()
     except Exception as e:
         logging.error('  ERROR: %s', e)
+        db.session.remove()
 
+
+def log_cache_stats():
+    logging.info('Redditor cache: %s hits, %s misses',
+                 redditor_cache.hits, redditor_cache.misses)
+    logging.info('Shadowban cache: %s hits, %s misses',
+                 check_shadowbanned.hits, check_shadowbanned.misses)
+
+
+def export_metrics():
+    """Writes the metrics file, if one is set in the config."""
+    path = cfg_option('metrics', 'path', '')
+    if not path:
+        return
+
+    for cache_name, hits, misses in [
+            ('redditor', redditor_cache.hits, redditor_cache.misses),
+            ('shadowban', check_shadowbanned.hits, check_shadowbanned.misses),
+            ('meme', meme_cache.hits, meme_cache.misses)]:
+        metrics.set('modbot_cache_hits', hits, cache=cache_name)
+        metrics.set('modbot_cache_misses', misses, cache=cache_name)
+        if hits + misses:
+            metrics.set('modbot_cache_hit_rate',
+                        float(hits) / (hits + misses), cache=cache_name)
+
+    try:
+        metrics.write(path)
+    except (IOError, OSError) as e:
+        logging.error('  ERROR: couldn\'t write metrics: %s', e)
+
+
+def run_once(concurrent=False):
+    """Does a single full run through all the queues and tasks."""
+    start_utc = datetime.utcnow()
+    start_time = time()
+
+    try:
+        login()
+        subreddits, sr_dict, snapshot = load_subreddits()
+    except Exception as e:
+        logging.error('  ERROR: %s', e)
+        return
+
+    check_queues(QUEUES, subreddits, sr_dict, snapshot, concurrent)
+
+    run_tasks(sr_dict, start_utc)
+
+    log_cache_stats()
+    metrics.observe('modbot_run_seconds', time() - start_time)
+    export_metrics()
     logging.info('Completed full run in %s', elapsed_since(start_time))
 
 
+class QueueSchedule(object):
+
+    """Decides when a queue should next be polled in daemon mode.
+
+    The interval adapts to the rate of new items seen in the queue, aiming for
+    about target_items new items per poll: busy queues get polled every few
+    seconds, and quiet ones back off towards max_interval.
+    """
+
+    def __init__(self, name, min_interval, max_interval, target_items):
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_items = target_items
+        self.interval = min_interval
+        self.rate = None
+        self.last_poll = None
+        self.next_poll = 0
+
+    def polled(self, poll_time, items):
+        """Updates the schedule after a poll that found some new items."""
+        if self.last_poll is not None:
+            elapsed = max(poll_time - self.last_poll, 1)
+            rate = float(items) / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                # smooth it out so one burst doesn't swing the interval
+                self.rate = 0.5 * rate + 0.5 * self.rate
+
+            if self.rate > 0:
+                self.interval = self.target_items / self.rate
+            else:
+                self.interval *= 2
+            self.interval = min(max(self.interval, self.min_interval),
+                                self.max_interval)
+
+        self.last_poll = poll_time
+        self.next_poll = poll_time + self.interval
+
+
+def run_daemon(concurrent=False):
+    """Keeps running, polling each queue on its own adaptive interval.
+
+    The reddit session stays logged in and the condition snapshot is only
+    reloaded every reload_interval seconds.
+    """
+    min_interval = cfg_option('daemon', 'min_interval', 5)
+    max_interval = cfg_option('daemon', 'max_interval', 300)
+    target_items = cfg_option('daemon', 'target_items', 25)
+    tasks_interval = cfg_option('daemon', 'tasks_interval', 60)
+    reload_interval = cfg_option('daemon', 'reload_interval', 300)
+    if lease_manager:
+        # reloading renews the leases, so it has to happen well before they
+        # would expire
+        reload_interval = min(reload_interval,
+                              lease_manager.lease_ttl // 3)
+
+    login()
+    schedules = [QueueSchedule(name, min_interval, max_interval, target_items)
+                 for name in QUEUES]
+    next_reload = 0
+    next_tasks = 0
+    tasks_since = datetime.utcnow()
+
+    while True:
+        try:
+            now = time()
+            if now >= next_reload:
+                db.session.commit()
+                subreddits, sr_dict, snapshot = load_subreddits()
+                next_reload = now + reload_interval
+
+            poll_time = time()
+            due = [s for s in schedules if s.next_poll <= poll_time]
+            if due:
+                counts = check_queues([s.name for s in due],
+                                      subreddits, sr_dict, snapshot,
+                                      concurrent)
+                for schedule in due:
+                    schedule.polled(poll_time, counts[schedule.name])
+                    logging.debug('  Next %s check in %ss',
+                                  schedule.name, int(schedule.interval))
+
+            if time() >= next_tasks:
+                tasks_start = datetime.utcnow()
+                run_tasks(sr_dict, tasks_since)
+                tasks_since = tasks_start
+                next_tasks = time() + tasks_interval
+                log_cache_stats()
+                export_metrics()
+            elif action_executor:
+                # nothing new might be logged for a while, don't hold on to
+                # what's waiting until the next tasks run
+                action_executor.flush_if_due()
+        except Exception as e:
+            logging.error('  ERROR: %s', e)
+            db.session.rollback()
+            sleep(min_interval)
+
+        next_wake = min([s.next_poll for s in schedules] +
+                        [next_tasks, next_reload])
+        sleep(max(next_wake - time(), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs AutoModerator.')
+    parser.add_argument('--daemon', action='store_true',
+        help='keep running and poll the queues continuously, instead of '
+             'doing a single run')
+    parser.add_argument('--concurrent', action='store_true',
+        help='check the report, spam, submission and comment queues at '
+             'the same time instead of one after another')
+    parser.add_argument('--shard', nargs='?', const='', metavar='WORKER',
+        help='only handle a share of the subreddits, split with any other '
+             'workers running with --shard on the same database. WORKER '
+             'must be unique per worker, and defaults to [shard] worker or '
+             'the host name and reddit username')
+    args = parser.parse_args()
+
+    logging.config.fileConfig(path_to_cfg)
+    logging.info('Imports took %.3fs', import_seconds)
+    metrics.set('modbot_import_seconds', import_seconds)
+    setup_caches()
+
+    global lease_manager
+    if args.shard is not None:
+        worker = (args.shard or cfg_option('shard', 'worker', '') or
+                  default_worker_id())
+        logging.info('Running sharded as worker %s', worker)
+        lease_manager = LeaseManager(worker,
+                                     cfg_option('shard', 'lease_ttl', 600))
+
+    global action_executor
+    action_executor = ActionExecutor(
+        cfg_option('actions', 'workers', 4),
+        cfg_option('actions', 'log_batch_size', 50),
+        cfg_option('actions', 'log_flush_interval', 10))
+
+    try:
+        if args.daemon:
+            run_daemon(args.concurrent)
+        else:
+            run_once(args.concurrent)
+    finally:
+        try:
+            action_executor.close()
+        except Exception as e:
+            logging.error('  ERROR: couldn\'t log actions: %s', e)
+        if meme_pool:
+            meme_pool.close()
+        # a daemon's subreddits can be taken over straight away, but a
+        # worker run from cron keeps its leases for its next run
+        if lease_manager and args.daemon:
+            try:
+                lease_manager.release()
+            except Exception as e:
+                logging.error('  ERROR: %s', e)
+
+
 if __name__ == '__main__':
     main()
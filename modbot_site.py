@@ -1,8 +1,16 @@
 from flask import Flask
 
+from models import db
+
 app = Flask(__name__)
 
 
+# give each request a fresh database session
+@app.teardown_request
+def remove_session(exception=None):
+    db.session.remove()
+
+
 # main page
 @app.route('/')
 def main_page():
@@ -1,24 +1,83 @@
 import sys, os
 from ConfigParser import SafeConfigParser
 
-from modbot_site import app
-from flaskext.sqlalchemy import SQLAlchemy
+from database import Database
 
 
-cfg_file = SafeConfigParser()
-path_to_cfg = os.path.abspath(os.path.dirname(sys.argv[0]))
-path_to_cfg = os.path.join(path_to_cfg, 'modbot.cfg')
-cfg_file.read(path_to_cfg)
+class LazyConfigParser(SafeConfigParser):
+
+    """Config parser that only reads its file the first time it's used."""
+
+    def __init__(self, path):
+        SafeConfigParser.__init__(self)
+        self.path = path
+        self.loaded = False
+
+    def load(self):
+        if not self.loaded:
+            self.loaded = True
+            self.read(self.path)
+
+    def sections(self):
+        self.load()
+        return SafeConfigParser.sections(self)
+
+    def has_section(self, section):
+        self.load()
+        return SafeConfigParser.has_section(self, section)
+
+    def has_option(self, section, option):
+        self.load()
+        return SafeConfigParser.has_option(self, section, option)
+
+    def options(self, section):
+        self.load()
+        return SafeConfigParser.options(self, section)
+
+    def get(self, section, option, *args, **kwargs):
+        self.load()
+        return SafeConfigParser.get(self, section, option, *args, **kwargs)
+
+    def items(self, section, *args, **kwargs):
+        self.load()
+        return SafeConfigParser.items(self, section, *args, **kwargs)
+
+
+# modbot.cfg next to the script being run, unless MODBOT_CFG says otherwise
+path_to_cfg = os.environ.get('MODBOT_CFG')
+if not path_to_cfg:
+    path_to_cfg = os.path.abspath(os.path.dirname(sys.argv[0]))
+    path_to_cfg = os.path.join(path_to_cfg, 'modbot.cfg')
+cfg_file = LazyConfigParser(path_to_cfg)
+
+
+def cfg_option(section, option, default):
+    """Returns an option from the config file, or default if it isn't set.
+
+    The value is converted to the same type as default.
+    """
+    if not cfg_file.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return cfg_file.getboolean(section, option)
+    elif isinstance(default, int):
+        return cfg_file.getint(section, option)
+    elif isinstance(default, float):
+        return cfg_file.getfloat(section, option)
+    return cfg_file.get(section, option)
 
 
 #    cfg_file.get('database', 'username')+':'+\
 #    cfg_file.get('database', 'password')+'@'+\
 #    cfg_file.get('database', 'host')+'/'+\
 
-app.config['SQLALCHEMY_DATABASE_URI'] = \
-    cfg_file.get('database', 'system')+'://'+\
-    cfg_file.get('database', 'database')
-db = SQLAlchemy(app)
+def database_uri():
+    """Returns the database URI from the config file."""
+    return (cfg_file.get('database', 'system')+'://'+
+            cfg_file.get('database', 'database'))
+
+# the engine is only created once it's first used
+db = Database(database_uri)
 
 
 class Subreddit(db.Model):
@@ -84,6 +143,11 @@ class Condition(db.Model):
     comment - If set, bot will post (and distinguish) this comment when an
         action is performed due to this condition
     notes - not used by bot, space to keep notes on a condition
+    timeout_strikes - How many times checking this condition's regex has
+        gone over the time budget
+    disabled - If True, the condition (and any condition it's a
+        sub-condition of) isn't checked. Set automatically when
+        timeout_strikes reaches the limit.
 
     """
 
@@ -124,6 +188,8 @@ class Condition(db.Model):
     spam = db.Column(db.Boolean)
     comment = db.Column(db.Text)
     notes = db.Column(db.Text)
+    timeout_strikes = db.Column(db.Integer)
+    disabled = db.Column(db.Boolean)
 
     subreddit = db.relationship('Subreddit',
         backref=db.backref('conditions', lazy='dynamic'))
@@ -131,6 +197,9 @@ class Condition(db.Model):
     additional_conditions = db.relationship('Condition',
         lazy='joined', join_depth=1)
 
+db.Index('ix_conditions_subreddit_parent',
+         Condition.subreddit_id, Condition.parent_id)
+
 
 class ActionLog(db.Model):
     """Table containing a log of the bot's actions."""
@@ -159,6 +228,11 @@ class ActionLog(db.Model):
     condition = db.relationship('Condition',
         backref=db.backref('actions', lazy='dynamic'))
 
+db.Index('ix_action_log_subreddit_permalink_action',
+         ActionLog.subreddit_id, ActionLog.permalink, ActionLog.action)
+db.Index('ix_action_log_action_time',
+         ActionLog.action, ActionLog.action_time)
+
 
 class AutoReapproval(db.Model):
     """Table keeping track of posts that have been auto-reapproved."""
@@ -177,3 +251,165 @@ class AutoReapproval(db.Model):
     subreddit = db.relationship('Subreddit',
         backref=db.backref('auto_reapprovals', lazy='dynamic'))
 
+db.Index('ix_auto_reapprovals_subreddit_permalink',
+         AutoReapproval.subreddit_id, AutoReapproval.permalink)
+
+
+
+class RedditorCache(db.Model):
+
+    """Table caching redditors' profile info between runs.
+
+    name - The redditor's username, lowercased
+    link_karma - Link karma when the profile was fetched
+    comment_karma - Comment karma when the profile was fetched
+    created_utc - When the account was created
+    is_gold - Whether the redditor had reddit gold
+    fetched_time - When the profile was fetched, used to expire entries
+    """
+
+    __tablename__ = 'redditor_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), nullable=False, unique=True)
+    link_karma = db.Column(db.Integer, nullable=False)
+    comment_karma = db.Column(db.Integer, nullable=False)
+    created_utc = db.Column(db.DateTime, nullable=False)
+    is_gold = db.Column(db.Boolean, nullable=False)
+    fetched_time = db.Column(db.DateTime, nullable=False)
+
+
+class ShadowbanCache(db.Model):
+
+    """Table caching whether redditors are shadowbanned.
+
+    name - The redditor's username, lowercased
+    is_shadowbanned - The verdict from the last check
+    checked_time - When the last check was done, used to expire entries
+        (banned and not-banned verdicts expire separately)
+    """
+
+    __tablename__ = 'shadowban_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), nullable=False, unique=True)
+    is_shadowbanned = db.Column(db.Boolean, nullable=False)
+    checked_time = db.Column(db.DateTime, nullable=False)
+
+
+class MemeCache(db.Model):
+
+    """Table caching the meme name found on meme pages.
+
+    url - The URL of the page the meme name was extracted from
+    meme_name - The meme name, or null if it couldn't be determined
+    fetched_time - When the page was loaded, used to expire entries
+    """
+
+    __tablename__ = 'meme_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    url = db.Column(db.String(255), nullable=False, unique=True)
+    meme_name = db.Column(db.String(255))
+    fetched_time = db.Column(db.DateTime, nullable=False)
+
+
+class SubredditLease(db.Model):
+
+    """Table of which bot worker is handling each subreddit in sharded mode.
+
+    subreddit_id - The subreddit the lease is for
+    worker - The id of the worker holding the lease
+    acquired_time - When the worker claimed the subreddit
+    heartbeat_time - When the worker last renewed the lease. Leases that
+        haven't been renewed for a while are taken over by other workers.
+    """
+
+    __tablename__ = 'subreddit_leases'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subreddit_id = db.Column(db.Integer,
+                             db.ForeignKey('subreddits.id'),
+                             nullable=False, unique=True)
+    worker = db.Column(db.String(255), nullable=False)
+    acquired_time = db.Column(db.DateTime, nullable=False)
+    heartbeat_time = db.Column(db.DateTime, nullable=False)
+
+db.Index('ix_subreddit_leases_worker', SubredditLease.worker)
+
+
+class WorkerHeartbeat(db.Model):
+
+    """Table of the bot workers running in sharded mode.
+
+    Kept apart from the leases so a worker that doesn't hold any yet still
+    counts towards everyone's share.
+
+    worker - The id of the worker
+    heartbeat_time - When the worker last claimed its subreddits. Workers
+        that haven't for a while are considered dead.
+    """
+
+    __tablename__ = 'worker_heartbeats'
+
+    id = db.Column(db.Integer, primary_key=True)
+    worker = db.Column(db.String(255), nullable=False, unique=True)
+    heartbeat_time = db.Column(db.DateTime, nullable=False)
+
+
+class QueueCursor(db.Model):
+
+    """Table of the newest item the bot has seen in each subreddit's queues.
+
+    queue - The queue the cursor is for: "spam", "submission" or "comment"
+    fullname - The reddit fullname (e.g. t3_abc12) of the newest item seen,
+        new items are fetched from after it
+    created_utc - When that item was created
+    updated_time - When the cursor last moved
+    item_rate - Smoothed number of new items per hour in the queue, used to
+        balance the comment listing between multireddits
+    """
+
+    __tablename__ = 'queue_cursors'
+
+    id = db.Column(db.Integer, primary_key=True)
+    subreddit_id = db.Column(db.Integer,
+                             db.ForeignKey('subreddits.id'),
+                             nullable=False)
+    queue = db.Column(db.String(20), nullable=False)
+    fullname = db.Column(db.String(20))
+    created_utc = db.Column(db.DateTime, nullable=False)
+    updated_time = db.Column(db.DateTime, nullable=False)
+    item_rate = db.Column(db.Float)
+
+db.Index('ix_queue_cursors_subreddit_queue',
+         QueueCursor.subreddit_id, QueueCursor.queue, unique=True)
+
+
+class ConditionStats(db.Model):
+
+    """Table of how each condition has done while being checked.
+
+    The totals are scaled down whenever evaluations goes over a limit, so
+    they follow how the condition does recently.
+
+    condition_id - The condition the stats are for
+    evaluations - How many times the condition has been checked
+    matches - How many of those checks matched
+    total_seconds - Time spent checking it, including its sub-conditions and
+        any user lookups
+    requests - How many reddit requests checking it made
+    updated_time - When the stats were last saved
+    """
+
+    __tablename__ = 'condition_stats'
+
+    id = db.Column(db.Integer, primary_key=True)
+    condition_id = db.Column(db.Integer,
+                             db.ForeignKey('conditions.id'),
+                             nullable=False, unique=True)
+    evaluations = db.Column(db.Float, nullable=False)
+    matches = db.Column(db.Float, nullable=False)
+    total_seconds = db.Column(db.Float, nullable=False)
+    requests = db.Column(db.Float, nullable=False)
+    updated_time = db.Column(db.DateTime, nullable=False)
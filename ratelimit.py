@@ -0,0 +1,93 @@
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+from time import time
+
+# priority classes for reddit requests, lower numbers go first
+PRIORITY_REMOVAL = 0    # removals and report alerts
+PRIORITY_LISTING = 1    # fetching the queues
+PRIORITY_APPROVAL = 2   # approvals, reapprovals and modmail replies
+PRIORITY_LOOKUP = 3     # redditor profile and shadowban lookups
+
+_context = threading.local()
+
+
+@contextmanager
+def priority(level):
+    """Makes requests in the with block (in this thread) use a priority."""
+    previous = getattr(_context, 'priority', None)
+    _context.priority = level
+    try:
+        yield
+    finally:
+        _context.priority = previous
+
+
+def current_priority():
+    """Returns the priority requests from this thread should use."""
+    level = getattr(_context, 'priority', None)
+    if level is None:
+        return PRIORITY_LISTING
+    return level
+
+
+class RequestScheduler(object):
+
+    """Token bucket for reddit requests, handing out tokens by priority.
+
+    Tokens refill at rate per second, up to burst. When requests are waiting
+    for a token, the one with the lowest priority number gets the next one
+    (oldest first within a priority), so removals don't queue up behind
+    lower-priority lookups while the rate limit is saturated.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time()
+        self.waiting = list()
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, level=None):
+        """Blocks until a request with the priority level is allowed.
+
+        Returns how many seconds were spent waiting.
+        """
+        if level is None:
+            level = current_priority()
+        start_time = time()
+
+        with self.condition:
+            ticket = (level, next(self.counter))
+            heapq.heappush(self.waiting, ticket)
+            acquired = False
+            try:
+                while True:
+                    self._refill()
+                    if self.waiting[0] == ticket:
+                        if self.tokens >= 1:
+                            heapq.heappop(self.waiting)
+                            self.tokens -= 1
+                            acquired = True
+                            # let the next in line start waiting for its token
+                            self.condition.notify_all()
+                            return time() - start_time
+                        self.condition.wait((1 - self.tokens) / self.rate)
+                    else:
+                        self.condition.wait()
+            finally:
+                if not acquired:
+                    # interrupted (e.g. KeyboardInterrupt) while waiting, the
+                    # ticket would otherwise block everyone queued behind it
+                    self.waiting.remove(ticket)
+                    heapq.heapify(self.waiting)
+                    self.condition.notify_all()
@@ -0,0 +1,272 @@
+"""Records reddit responses to a fixture file and replays them offline.
+
+Recording logs in with the account from modbot.cfg and fetches everything
+the bot would read (the queue listings, the modqueue, the reports page and
+the profiles/overviews of every author seen), without performing any
+actions:
+
+    python replay.py record fixtures.json
+
+Benchmarking replays a fixture file through check_items for each queue with
+a simulated latency per request, and reports the throughput:
+
+    python replay.py bench fixtures.json [--latency 0.5]
+
+Actions are not sent anywhere during a benchmark, and meme pages aren't
+fetched. The subreddits and conditions are copied from the database in
+modbot.cfg into an in-memory sqlite database, and everything the benchmark
+writes (the action log, cache entries, cursors) goes there, so the real
+database is only read from.
+"""
+import argparse
+import json
+import logging, logging.config
+import threading
+import urllib
+import urllib2
+from datetime import datetime
+from time import time, sleep
+
+import reddit
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+import modbot
+from httppool import HTTPPoolError
+from models import path_to_cfg, cfg_file, db, Subreddit, Condition, \
+    ConditionStats
+
+# the queues that are recorded and benchmarked, in the order the bot runs them
+QUEUES = ('report', 'spam', 'submission', 'comment')
+REPORTS_PAGE = 'http://www.reddit.com/r/mod/about/reports'
+# copied into the benchmark's scratch database, everything else starts empty
+SCRATCH_MODELS = (Subreddit, Condition, ConditionStats)
+
+
+def request_key(page_url, url_data=None):
+    """Returns the key a request's response is stored under."""
+    if url_data:
+        page_url += '?'+urllib.urlencode(sorted(url_data.items()))
+    return page_url
+
+
+class RecordingReddit(reddit.Reddit):
+
+    """A reddit session that keeps a copy of every response it gets."""
+
+    def __init__(self, *args, **kwargs):
+        reddit.Reddit.__init__(self, *args, **kwargs)
+        self.responses = dict()
+
+    def _request(self, page_url, params=None, url_data=None, timeout=None):
+        response = {'status': 200, 'body': None}
+        try:
+            response['body'] = reddit.Reddit._request(self, page_url,
+                params=params, url_data=url_data, timeout=timeout)
+            return response['body']
+        except urllib2.HTTPError as e:
+            response['status'] = e.code
+            raise
+        finally:
+            # only keep reads, logging in etc. doesn't need replaying
+            if params is None:
+                self.responses[request_key(page_url, url_data)] = response
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'recorded': datetime.utcnow().isoformat(),
+                       'responses': self.responses}, f)
+
+
+class ReplayReddit(reddit.Reddit):
+
+    """A stand-in reddit session that serves recorded responses.
+
+    Each request sleeps for latency seconds first, to simulate the time it
+    would take against the real site. Anything sent to reddit (actions,
+    comments, messages) just gets an empty response, and reads that weren't
+    recorded get a 404.
+    """
+
+    def __init__(self, responses, latency=0.0, user_agent='replay'):
+        reddit.Reddit.__init__(self, user_agent=user_agent)
+        self.responses = responses
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path, latency=0.0):
+        with open(path) as f:
+            return cls(json.load(f)['responses'], latency)
+
+    def _request(self, page_url, params=None, url_data=None, timeout=None):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            sleep(self.latency)
+
+        if params is not None:
+            return '{}'
+
+        key = request_key(page_url, url_data)
+        response = self.responses.get(key)
+        if response is None:
+            raise urllib2.HTTPError(key, 404, 'Not recorded', None, None)
+        if response['status'] != 200:
+            raise urllib2.HTTPError(key, response['status'],
+                                    'Recorded error', None, None)
+        return response['body']
+
+    def login(self, *args, **kwargs):
+        pass
+
+
+def record(path):
+    """Fetches everything the bot reads and saves it to a fixture file."""
+    r = RecordingReddit(user_agent=cfg_file.get('reddit', 'user_agent'))
+    r.login(cfg_file.get('reddit', 'username'),
+            cfg_file.get('reddit', 'password'))
+    modbot.r = r
+    subreddits, sr_dict, snapshot = modbot.load_subreddits()
+
+    authors = set()
+    for name in QUEUES + ('modqueue',):
+        items = modbot.get_queue_listing(name, subreddits)
+        if items is None:
+            continue
+        count = 0
+        for item in items:
+            count += 1
+            if item.author:
+                authors.add(item.author.name)
+        logging.info('Recorded %s %s items', count, name)
+
+    r._request(REPORTS_PAGE)
+
+    for author in authors:
+        try:
+            r.get_redditor(author)
+        except Exception:
+            pass
+        try:
+            list(r.get_redditor(author, fetch=False).get_overview(limit=1))
+        except Exception:
+            pass
+    logging.info('Recorded %s redditors', len(authors))
+
+    r.save(path)
+    logging.info('Saved %s responses to %s', len(r.responses), path)
+
+
+class OfflinePool(object):
+
+    """Stands in for modbot's meme page pool, without going to the network."""
+
+    def fetch(self, url):
+        raise HTTPPoolError('%s not fetched while replaying' % url)
+
+    def close(self):
+        pass
+
+
+def use_scratch_database():
+    """Switches db to an in-memory copy of the subreddits and conditions."""
+    source = db.engine
+    # one shared connection, or every new one would get an empty database
+    scratch = create_engine('sqlite://', poolclass=StaticPool,
+                            connect_args={'check_same_thread': False},
+                            convert_unicode=True)
+
+    # pysqlite's own transaction handling breaks SAVEPOINT (used by
+    # save_cache_entry()), so leave it off and emit BEGIN ourselves
+    @event.listens_for(scratch, 'connect')
+    def disable_pysqlite_begin(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(scratch, 'begin')
+    def emit_begin(connection):
+        connection.execute('BEGIN')
+
+    db.metadata.create_all(bind=scratch)
+    for model in SCRATCH_MODELS:
+        table = model.__table__
+        rows = [dict(row) for row in source.execute(table.select())]
+        if rows:
+            scratch.execute(table.insert(), rows)
+    db.use_engine(scratch)
+    source.dispose()
+
+
+def benchmark(path, latency):
+    """Replays a fixture file through each queue and reports throughput."""
+    r = ReplayReddit.from_file(path, latency)
+    modbot.r = r
+    subreddits, sr_dict, snapshot = modbot.load_subreddits()
+
+    statements = [0]
+    def count_statement(*args):
+        statements[0] += 1
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+
+    results = list()
+    for name in QUEUES:
+        items = modbot.get_queue_listing(name, subreddits)
+        if items is None:
+            continue
+        modqueue = None
+        if name == 'spam':
+            modqueue = modbot.ModqueueIndex(
+                lambda: modbot.get_queue_listing('modqueue', subreddits))
+
+        start_requests = r.requests
+        start_statements = statements[0]
+        start_time = time()
+        count = modbot.check_items(name, items, sr_dict, datetime.min,
+                                   snapshot, modqueue)
+        if modbot.action_executor:
+            modbot.action_executor.wait()
+        elapsed = time() - start_time
+
+        results.append((name, count, elapsed,
+                        r.requests - start_requests,
+                        statements[0] - start_statements))
+
+    event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    print '%-12s %8s %10s %10s %10s %12s' % ('queue', 'items', 'seconds',
+        'items/sec', 'requests', 'statements')
+    for name, count, elapsed, requests, queries in results:
+        print '%-12s %8d %10.2f %10.1f %10d %12d' % (name, count, elapsed,
+            count / elapsed if elapsed else 0.0, requests, queries)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Records reddit responses or benchmarks against them.')
+    subparsers = parser.add_subparsers(dest='command')
+    record_parser = subparsers.add_parser('record',
+        help='record the current listings to a fixture file')
+    record_parser.add_argument('path')
+    bench_parser = subparsers.add_parser('bench',
+        help='benchmark check_items against a fixture file')
+    bench_parser.add_argument('path')
+    bench_parser.add_argument('--latency', type=float, default=0.0,
+        help='seconds of simulated latency per request')
+    args = parser.parse_args()
+
+    logging.config.fileConfig(path_to_cfg)
+    modbot.setup_caches()
+
+    if args.command == 'record':
+        record(args.path)
+    else:
+        use_scratch_database()
+        modbot.meme_pool = OfflinePool()
+        modbot.action_executor = modbot.ActionExecutor(0, 1000, 60)
+        benchmark(args.path, args.latency)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from models import db, SubredditLease, WorkerHeartbeat
+from leases import LeaseManager
+
+
+SUBREDDIT_IDS = range(1, 11)
+
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        db.use_engine(create_engine('sqlite://'))
+        db.create_all()
+        self.a = LeaseManager('a', lease_ttl=600)
+        self.b = LeaseManager('b', lease_ttl=600)
+
+    def tearDown(self):
+        db.session.remove()
+
+    def test_new_worker_gets_a_share(self):
+        self.assertEqual(self.a.claim(SUBREDDIT_IDS), set(SUBREDDIT_IDS))
+
+        # b holds no leases yet, but its heartbeat row makes a give some up
+        self.assertEqual(self.b.claim(SUBREDDIT_IDS), set())
+        a_owned = self.a.claim(SUBREDDIT_IDS)
+        self.assertEqual(len(a_owned), 5)
+        b_owned = self.b.claim(SUBREDDIT_IDS)
+        self.assertEqual(len(b_owned), 5)
+        self.assertFalse(a_owned & b_owned)
+
+        # nothing moves once the shares are even
+        self.assertEqual(self.a.claim(SUBREDDIT_IDS), a_owned)
+        self.assertEqual(self.b.claim(SUBREDDIT_IDS), b_owned)
+
+    def test_released_worker_stops_counting(self):
+        self.a.claim(SUBREDDIT_IDS)
+        self.b.claim(SUBREDDIT_IDS)
+        self.a.claim(SUBREDDIT_IDS)
+        self.b.claim(SUBREDDIT_IDS)
+
+        self.b.release()
+        self.assertEqual(self.a.claim(SUBREDDIT_IDS), set(SUBREDDIT_IDS))
+
+    def test_dead_worker_is_taken_over(self):
+        self.a.claim(SUBREDDIT_IDS)
+        self.b.claim(SUBREDDIT_IDS)
+        self.a.claim(SUBREDDIT_IDS)
+        self.b.claim(SUBREDDIT_IDS)
+
+        # b stops heartbeating
+        stale = datetime.utcnow() - timedelta(seconds=601)
+        for model in (WorkerHeartbeat, SubredditLease):
+            (db.session.query(model)
+                .filter(model.worker == 'b')
+                .update({'heartbeat_time': stale}))
+        db.session.commit()
+        self.assertEqual(self.a.claim(SUBREDDIT_IDS), set(SUBREDDIT_IDS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import re
+import unittest
+
+from matching import REGEX_FLAGS, LiteralMatcher, LiteralSet, SuffixTrie, \
+    DomainTrie, parse_literals, get_matcher
+
+
+class Condition(object):
+
+    def __init__(self, value):
+        self.value = value
+        self.additional_conditions = []
+
+
+# what each value should be indexed as, None for staying a regex
+VALUES = [
+    (u'bit\\.ly', LiteralSet),
+    (u'(bit\\.ly|goo\\.gl|t\\.co)', LiteralSet),
+    (u'colou?r', LiteralSet),
+    (u'[ab]c', LiteralSet),
+    (u'.*(\\.ru|\\.cn)', SuffixTrie),
+    (u'.*?\\.ru', SuffixTrie),
+    (u'(.*\\.)?(example\\.com|example\\.net)', DomainTrie),
+    (u'(.*\\.)?example\\.com', DomainTrie),
+    (u'BIT\\.LY', LiteralSet),
+    # values and test strings are both lowercased, so (?i) changes nothing
+    (u'a(?i)b', LiteralSet),
+    (u'^a|b$', None),
+    (u'a+', None),
+    (u'.*', None),
+    (u'', None),
+]
+
+STRINGS = [
+    u'', u'\n', u'bit.ly', u'bit.ly\n', u'bitxly', u'abit.ly', u'goo.gl',
+    u't.co', u't.com', u'color', u'colour', u'colouur', u'ac', u'bc', u'cc',
+    u'foo.ru', u'.ru', u'ru', u'foo.cn\n', u'foo.rub', u'example.com',
+    u'www.example.com', u'a.b.example.net', u'badexample.com',
+    u'example.com.evil', u'.example.com', u'a', u'b', u'aab', u'ab\nab',
+]
+
+
+class LiteralMatcherTest(unittest.TestCase):
+
+    def test_classification(self):
+        for value, index_class in VALUES:
+            literals = parse_literals(value)
+            if index_class is None:
+                self.assertEqual(literals, None, value)
+            else:
+                self.assertEqual(literals[0], index_class, value)
+
+    def test_same_results_as_regex(self):
+        for value, index_class in VALUES:
+            if index_class is None:
+                continue
+            matcher = get_matcher(Condition(value))
+            self.assertTrue(isinstance(matcher, LiteralMatcher), value)
+            regex = re.compile(u'^%s$' % value.lower(), REGEX_FLAGS)
+            for test_string in STRINGS:
+                self.assertEqual(bool(matcher.search(test_string)),
+                                 bool(regex.search(test_string)),
+                                 '%r against %r' % (value, test_string))
+
+
+if __name__ == '__main__':
+    unittest.main()
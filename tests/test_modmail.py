@@ -0,0 +1,118 @@
+import unittest
+from calendar import timegm
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+from models import cfg_file, db, Subreddit, ActionLog
+from modbot import respond_to_modmail
+
+
+START = datetime(2013, 1, 1)
+
+
+class Author(object):
+
+    def __init__(self, name):
+        self.name = name
+
+
+class Message(object):
+
+    def __init__(self, dest, author, created, replies=()):
+        self.dest = dest
+        self.author = Author(author)
+        self.created_utc = timegm((START + created).utctimetuple())
+        self.replies = list(replies)
+        self.sent = list()
+
+    def reply(self, text):
+        self.sent.append(text)
+
+
+class RespondToModmailTest(unittest.TestCase):
+
+    def setUp(self):
+        db.use_engine(create_engine('sqlite://'))
+        db.create_all()
+        if not cfg_file.has_section('reddit'):
+            cfg_file.add_section('reddit')
+        cfg_file.set('reddit', 'username', 'TestBot')
+
+        self.subreddits = dict()
+        for name in ('Pics', 'news'):
+            subreddit = Subreddit()
+            subreddit.name = name
+            subreddit.last_submission = START
+            subreddit.last_spam = START
+            subreddit.last_comment = START
+            db.session.add(subreddit)
+            self.subreddits[name] = subreddit
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+
+    def approve(self, sr_name, user, created):
+        entry = ActionLog()
+        entry.subreddit_id = self.subreddits[sr_name].id
+        entry.user = user
+        entry.created_utc = START + created
+        entry.action_time = START + timedelta(minutes=10)
+        entry.action = 'approve'
+        db.session.add(entry)
+        db.session.commit()
+
+    def test_replies_once_per_message(self):
+        self.approve('Pics', 'alice', timedelta(minutes=1))
+        self.approve('Pics', 'alice', timedelta(minutes=2))
+        message = Message('#pics', 'alice', timedelta(minutes=3))
+
+        respond_to_modmail([message], START)
+        self.assertEqual(len(message.sent), 1)
+        self.assertTrue('TestBot' in message.sent[0])
+
+    def test_only_matching_messages(self):
+        self.approve('Pics', 'alice', timedelta(minutes=5))
+        self.approve('news', 'bob', timedelta(minutes=5))
+        modmail = [
+            # newest first, like the real listing
+            Message('#news', 'alice', timedelta(minutes=9)),
+            Message('#pics', 'carol', timedelta(minutes=8)),
+            Message('#pics', 'bob', timedelta(minutes=7)),
+            Message('#news', 'bob', timedelta(minutes=6), replies=['hi']),
+            # sent before the item, so it can't be about it
+            Message('#pics', 'alice', timedelta(minutes=4)),
+        ]
+
+        respond_to_modmail(modmail, START)
+        self.assertEqual([len(m.sent) for m in modmail], [0, 0, 0, 0, 0])
+
+    def test_newest_unreplied_message_gets_the_reply(self):
+        self.approve('news', 'bob', timedelta(minutes=1))
+        newer = Message('#news', 'bob', timedelta(minutes=6))
+        older = Message('#news', 'bob', timedelta(minutes=3))
+
+        respond_to_modmail([newer, older], START)
+        self.assertEqual((len(newer.sent), len(older.sent)), (1, 0))
+
+    def test_only_own_subreddits(self):
+        self.approve('Pics', 'alice', timedelta(minutes=1))
+        self.approve('news', 'bob', timedelta(minutes=1))
+        pics = Message('#pics', 'alice', timedelta(minutes=3))
+        news = Message('#news', 'bob', timedelta(minutes=2))
+
+        respond_to_modmail([pics, news], START,
+                           [self.subreddits['news'].id])
+        self.assertEqual((len(pics.sent), len(news.sent)), (0, 1))
+
+    def test_old_approvals_ignored(self):
+        self.approve('Pics', 'alice', timedelta(minutes=1))
+        message = Message('#pics', 'alice', timedelta(minutes=3))
+
+        respond_to_modmail([message], START + timedelta(hours=1))
+        self.assertEqual(message.sent, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
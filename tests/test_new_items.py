@@ -0,0 +1,126 @@
+import unittest
+from datetime import datetime
+
+import modbot
+from modbot import Cursor, get_new_items
+
+
+class Item(object):
+
+    def __init__(self, number):
+        self.name = 't3_%d' % number
+        self.created_utc = 1000000 + number
+
+
+class Listing(object):
+
+    def __init__(self, newest):
+        self.newest = newest
+
+    def get_new_by_date(self, limit):
+        return self.newest[:limit]
+
+
+class FakeReddit(object):
+
+    """Serves the /new listing as pages of page_size, read with before=."""
+
+    def __init__(self, count, page_size=3):
+        self.items = [Item(n) for n in range(1, count + 1)]
+        self.page_size = page_size
+        self.requests = list()
+
+    def request_json(self, url, url_data):
+        self.requests.append(dict(url_data))
+        names = [i.name for i in self.items]
+        start = names.index(url_data['before']) + 1
+        page = self.items[start:start + self.page_size]
+        before = None
+        if start + self.page_size < len(self.items):
+            before = page[-1].name
+        return {'data': {'children': list(reversed(page)),
+                         'before': before}}
+
+    def get_subreddit(self, name):
+        return Listing(list(reversed(self.items)))
+
+
+class Subreddit(object):
+
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.reported_comments_only = False
+
+
+def cursor(item):
+    return Cursor(item.name, datetime.utcfromtimestamp(item.created_utc),
+                  None)
+
+
+class GetNewItemsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.r = modbot.r
+        self.subreddits = [Subreddit(1, 'a'), Subreddit(2, 'b')]
+
+    def tearDown(self):
+        modbot.r = self.r
+
+    def cursors(self, first, second):
+        return {1: first, 2: second}
+
+    def test_reads_forwards_from_newest_cursor(self):
+        modbot.r = FakeReddit(10)
+        items = modbot.r.items
+        cursors = self.cursors(cursor(items[1]), cursor(items[2]))
+
+        new = get_new_items('submission', self.subreddits, cursors)
+        self.assertEqual([i.name for i in new],
+                         [i.name for i in reversed(items[3:])])
+        self.assertEqual([r['before'] for r in modbot.r.requests],
+                         ['t3_3', 't3_6', 't3_9'])
+
+    def test_stops_at_max_new_pages(self):
+        page_size = 3
+        modbot.r = FakeReddit(page_size * (modbot.MAX_NEW_PAGES + 5),
+                              page_size)
+        items = modbot.r.items
+        cursors = self.cursors(cursor(items[0]), cursor(items[0]))
+
+        new = get_new_items('submission', self.subreddits, cursors)
+        self.assertEqual(len(modbot.r.requests), modbot.MAX_NEW_PAGES)
+        self.assertEqual(len(new), page_size * modbot.MAX_NEW_PAGES)
+        # still newest first, and no gap after the cursor
+        self.assertEqual(new[-1].name, items[1].name)
+        self.assertEqual([i.created_utc for i in new],
+                         sorted([i.created_utc for i in new], reverse=True))
+
+    def test_nothing_new(self):
+        modbot.r = FakeReddit(5)
+        items = modbot.r.items
+        cursors = self.cursors(cursor(items[4]), cursor(items[0]))
+        self.assertEqual(get_new_items('submission', self.subreddits,
+                                       cursors), [])
+
+    def test_cursor_item_gone(self):
+        modbot.r = FakeReddit(5)
+        gone = Item(3)
+        gone.name = 't3_removed'
+        modbot.r.request_json = lambda url, url_data: {
+            'data': {'children': [], 'before': None}}
+        cursors = self.cursors(cursor(gone), cursor(modbot.r.items[0]))
+        self.assertEqual(get_new_items('submission', self.subreddits,
+                                       cursors), None)
+
+    def test_no_cursor(self):
+        modbot.r = FakeReddit(5)
+        cursors = self.cursors(Cursor(None, datetime.min, None),
+                               Cursor(None, datetime.min, None))
+        self.assertEqual(get_new_items('submission', self.subreddits,
+                                       cursors), None)
+        self.assertEqual(modbot.r.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from modbot import parse_reports_page
+
+
+def thing(permalink, stamp, approver=None):
+    checkmark = ''
+    if approver:
+        checkmark = ('<img class="approval-checkmark" '
+                     'title="approved by %s" src="/check.png">' % approver)
+    return ('<div class="thing id-t3_x link">'
+            '<div class="entry"><p class="title">A &amp; B</p>'
+            '<div class="child"><div></div></div>'
+            '<ul class="flat-list buttons">'
+            '<li class="first"><a href="%s">comments</a></li>'
+            '<li><a href="http://www.reddit.com/other">share</a></li></ul>'
+            '<span class="reported-stamp stamp">%s</span>%s'
+            '</div></div>' % (permalink, stamp, checkmark))
+
+
+PAGE = ('<html><body><div class="content"><div class="sitetable">' +
+        thing('http://www.reddit.com/r/Pics/comments/1/a/',
+              'reported: 3') +
+        thing('http://www.reddit.com/r/news/comments/2/b/',
+              'reported:<b> 12</b>', 'SomeMod') +
+        # no reports, and a link outside reddit, are both skipped
+        thing('http://www.reddit.com/r/news/comments/3/c/', 'reported') +
+        thing('http://example.com/r/news/comments/4/d/', 'reported: 1') +
+        thing('http://www.reddit.com/r/news/comments/5/e/', 'reported: 2') +
+        '</div></div></body></html>')
+
+EXPECTED = [
+    ('http://www.reddit.com/r/Pics/comments/1/a/', 'pics', 3, None),
+    ('http://www.reddit.com/r/news/comments/2/b/', 'news', 12, 'SomeMod'),
+    ('http://www.reddit.com/r/news/comments/5/e/', 'news', 2, None),
+]
+
+
+class ReportsPageTest(unittest.TestCase):
+
+    def test_whole_page(self):
+        self.assertEqual(list(parse_reports_page(PAGE)), EXPECTED)
+
+    def test_chunked(self):
+        # split everywhere, including inside tags and the stamps' text
+        for chunk_size in (1, 2, 7, 50, 333):
+            self.assertEqual(
+                list(parse_reports_page(PAGE, chunk_size=chunk_size)),
+                EXPECTED, 'chunk_size %s' % chunk_size)
+
+    def test_empty(self):
+        self.assertEqual(list(parse_reports_page('')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()